@@ -1,35 +1,47 @@
 """Admin API for monitoring and management."""
 from fastapi import FastAPI, Depends, HTTPException, Header, Query
-from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import func, distinct, cast
-from sqlalchemy.types import Date
+from sqlalchemy import Float, cast, func, select, union, union_all, literal
 from database import (
     get_db,
     User,
     Payment,
     AnalysisSession,
+    DashboardSummary,
     Referral,
     UserNotification,
 )
 from config import settings
+from redis_client import redis_client, redis_available, ActivityTracker
 from datetime import datetime, timedelta
 from typing import Optional
+import hmac
+import orjson
 import os
 
-app = FastAPI(title="Pulse Bot Admin API")
+# orjson serializes responses in C (datetimes natively) and skips FastAPI's
+# jsonable_encoder pass over every row dict.
+app = FastAPI(title="Pulse Bot Admin API", default_response_class=ORJSONResponse)
+# Dashboard JSON is highly repetitive (series of {"date", "count"} dicts) and
+# compresses 5-10x; level 5 keeps CPU cost negligible for these payloads.
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
+# Encoded once at import; every request compares against these bytes.
+_ADMIN_SECRET = settings.admin_secret_key.encode() if settings.admin_secret_key else None
 
 
 def verify_admin_token(authorization: Optional[str] = Header(None)):
     """Verify admin token."""
-    if not settings.admin_secret_key:
+    if not _ADMIN_SECRET:
         raise HTTPException(status_code=503, detail="Admin API is not configured")
 
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header required")
 
-    token = authorization.replace("Bearer ", "")
-    if token != settings.admin_secret_key:
+    token = authorization.removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode(), _ADMIN_SECRET):
         raise HTTPException(status_code=403, detail="Invalid admin token")
 
     return token
@@ -39,8 +51,47 @@ def _days_ago(days: int):
     return datetime.utcnow() - timedelta(days=days)
 
 
-def _dashboard_html() -> str:
-    """Load dashboard HTML from static file."""
+# Stats are stale-tolerant: admins polling within the TTL get the cached payload
+# without re-running the aggregations.
+STATS_CACHE_TTL = 45  # seconds
+
+
+def _cache_get(key: str) -> Optional[Response]:
+    """Return cached stats payload as a ready Response, or None on miss."""
+    if not redis_available or not redis_client:
+        return None
+    try:
+        raw = redis_client.get(f"admin_stats:{key}")
+    except Exception:
+        return None
+    if raw is None:
+        return None
+    return Response(content=raw, media_type="application/json")
+
+
+def _cache_put(key: str, data):
+    """Store stats payload in Redis and return it for the response."""
+    if redis_available and redis_client:
+        try:
+            redis_client.setex(f"admin_stats:{key}", STATS_CACHE_TTL, orjson.dumps(data))
+        except Exception:
+            pass
+    return data
+
+
+def _tariff_counts(db: Session) -> dict:
+    """Completed payments per tariff in a single GROUP BY query."""
+    rows = (
+        db.query(Payment.tariff, func.count(Payment.id))
+        .filter(Payment.status == "completed")
+        .group_by(Payment.tariff)
+        .all()
+    )
+    return dict(rows)
+
+
+def _load_dashboard_html() -> str:
+    """Load dashboard HTML from static file (once, at import time)."""
     base = os.path.dirname(os.path.abspath(__file__))
     path = os.path.join(base, "static", "dashboard.html")
     if os.path.isfile(path):
@@ -49,10 +100,14 @@ def _dashboard_html() -> str:
     return "<!DOCTYPE html><html><body><h1>Dashboard not found</h1></body></html>"
 
 
+# Static HTML only changes at deploy time — read it once instead of per request.
+_DASHBOARD_HTML = _load_dashboard_html()
+
+
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_page():
     """Serve admin dashboard (auth via token in JS)."""
-    return HTMLResponse(content=_dashboard_html())
+    return HTMLResponse(content=_DASHBOARD_HTML)
 
 
 @app.get("/")
@@ -65,190 +120,114 @@ async def root():
 
 
 @app.get("/stats/dashboard")
-async def get_dashboard(
+def get_dashboard(
     days: int = Query(30, ge=7, le=90),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Aggregated metrics for admin dashboard (overview + time series)."""
+    cached = _cache_get(f"dashboard:{days}")
+    if cached is not None:
+        return cached
+
+    # One timestamp per request: every window is derived from the same `now`,
+    # so all statements share stable bind parameters.
     now = datetime.utcnow()
-    since = _days_ago(days)
+    since = now - timedelta(days=days)
+    since_7 = now - timedelta(days=7)
+
+    active = User.active_filter(now)
+    completed = Payment.status == "completed"
+
+    def active_users_subq(since_val):
+        # UNION (not UNION ALL) deduplicates user_ids across both sources in SQL.
+        return union(
+            select(Payment.user_id).where(completed, Payment.completed_at >= since_val),
+            select(AnalysisSession.user_id).where(AnalysisSession.created_at >= since_val),
+        ).subquery()
+
+    # Active-user KPIs come from per-day HyperLogLogs (one pfcount, ~0.8%
+    # error) when Redis is up; the UNION subqueries stay as the exact fallback.
+    hll_7 = ActivityTracker.count_active(7)
+    hll_days = ActivityTracker.count_active(days)
+    use_hll = hll_7 is not None and hll_days is not None
+
+    # All scalar KPIs in one round-trip: one row of scalar subqueries.
+    overview_cols = [
+        select(func.count(User.id)).scalar_subquery().label("total_users"),
+        select(func.count(User.id)).where(active).scalar_subquery().label("active_subs"),
+        select(func.count(User.id)).where(active, User.subscription_plan == "basic").scalar_subquery().label("basic_active"),
+        select(func.count(User.id)).where(active, User.subscription_plan == "premium").scalar_subquery().label("premium_active"),
+        select(func.count(AnalysisSession.id)).scalar_subquery().label("total_analyses"),
+        select(func.coalesce(func.sum(Payment.amount), 0)).where(completed).scalar_subquery().label("total_revenue"),
+        select(func.count(User.id)).where(User.has_paid == True).scalar_subquery().label("paid_users"),
+        select(func.coalesce(func.sum(Payment.amount), 0)).where(completed, Payment.completed_at >= since).scalar_subquery().label("revenue_30d"),
+        select(func.count(Referral.id)).scalar_subquery().label("total_referrals"),
+        select(func.coalesce(func.sum(Referral.bonus_requests), 0)).scalar_subquery().label("total_bonus_given"),
+        select(func.count(UserNotification.id)).scalar_subquery().label("notifications_created"),
+        select(func.count(UserNotification.id)).where(UserNotification.sent == True).scalar_subquery().label("notifications_sent"),
+    ]
+    if not use_hll:
+        overview_cols.append(
+            select(func.count()).select_from(active_users_subq(since_7)).scalar_subquery().label("active_users_7d"))
+        overview_cols.append(
+            select(func.count()).select_from(active_users_subq(since)).scalar_subquery().label("active_users_30d"))
+    o = db.execute(select(*overview_cols)).one()
+    active_7d = hll_7 if use_hll else o.active_users_7d
+    active_30d = hll_days if use_hll else o.active_users_30d
 
-    # Overview
-    total_users = db.query(User).count()
-    active_subs = db.query(User).filter(
-        User.subscription_status == "active",
-        User.subscription_expire_at > now,
-    ).count()
-    total_analyses = db.query(AnalysisSession).count()
-    total_revenue = (
-        db.query(func.sum(Payment.amount))
-        .filter(Payment.status == "completed")
-        .scalar()
-        or 0
-    )
-    paid_users = (
-        db.query(func.count(distinct(Payment.user_id)))
-        .filter(Payment.status == "completed")
-        .scalar()
-        or 0
-    )
-    conversion = (paid_users / total_users * 100) if total_users else 0
-
-    # Plans: active by plan
-    basic_active = db.query(User).filter(
-        User.subscription_status == "active",
-        User.subscription_expire_at > now,
-        User.subscription_plan == "basic",
-    ).count()
-    premium_active = db.query(User).filter(
-        User.subscription_status == "active",
-        User.subscription_expire_at > now,
-        User.subscription_plan == "premium",
-    ).count()
+    conversion = (o.paid_users / o.total_users * 100) if o.total_users else 0
 
     # Payments by tariff (all time completed)
-    payments_by_tariff = (
-        db.query(Payment.tariff, func.count(Payment.id))
-        .filter(Payment.status == "completed")
-        .group_by(Payment.tariff)
-        .all()
-    )
-    tariff_counts = {t: c for t, c in payments_by_tariff}
-
-    # New users per day (last N days)
-    users_per_day = (
-        db.query(cast(User.created_at, Date), func.count(User.id))
-        .filter(User.created_at >= since)
-        .group_by(cast(User.created_at, Date))
-        .order_by(cast(User.created_at, Date))
-        .all()
-    )
-    users_daily = [{"date": d.isoformat(), "count": c} for d, c in users_per_day]
-
-    # Analyses per day
-    analyses_per_day = (
-        db.query(cast(AnalysisSession.created_at, Date), func.count(AnalysisSession.id))
-        .filter(AnalysisSession.created_at >= since)
-        .group_by(cast(AnalysisSession.created_at, Date))
-        .order_by(cast(AnalysisSession.created_at, Date))
-        .all()
-    )
-    analyses_daily = [{"date": d.isoformat(), "count": c} for d, c in analyses_per_day]
-
-    # Revenue per day (by completed_at or payment_date)
-    rev_query = db.query(
-        func.coalesce(
-            cast(Payment.payment_date, Date),
-            cast(Payment.completed_at, Date),
-            cast(Payment.created_at, Date),
-        ),
-        func.sum(Payment.amount),
-    ).filter(
-        Payment.status == "completed",
-        Payment.completed_at >= since,
-    )
-    rev_per_day = rev_query.group_by(
-        func.coalesce(
-            cast(Payment.payment_date, Date),
-            cast(Payment.completed_at, Date),
-            cast(Payment.created_at, Date),
-        )
-    ).order_by(
-        func.coalesce(
-            cast(Payment.payment_date, Date),
-            cast(Payment.completed_at, Date),
-            cast(Payment.created_at, Date),
-        )
-    ).all()
-    revenue_daily = [{"date": d.isoformat(), "amount": float(s)} for d, s in rev_per_day]
-
-    # Active users: had payment or analysis in period
-    user_ids_payment = (
-        db.query(distinct(Payment.user_id))
-        .filter(Payment.status == "completed", Payment.completed_at >= since)
-        .subquery()
-    )
-    user_ids_analysis = (
-        db.query(distinct(AnalysisSession.user_id))
-        .filter(AnalysisSession.created_at >= since)
-        .subquery()
-    )
-    active_count_7 = 0
-    active_count_30 = 0
-    since_7 = _days_ago(7)
-    for subq, since_val in [
-        (user_ids_payment, since_7),
-        (user_ids_analysis, since_7),
-    ]:
-        # Count distinct over union is heavier; approximate: count from payments in 7d + analyses in 7d (with distinct in app). Simpler: one query per source and sum distinct in Python or use raw.
-        pass
-    # Simpler: active in last 7 days = distinct user_id from (payments where completed_at >= since_7) OR (analysis_sessions where created_at >= since_7)
-    try:
-        from sqlalchemy import union_all
-        pay_7 = db.query(Payment.user_id).filter(
-            Payment.status == "completed", Payment.completed_at >= since_7
-        ).distinct()
-        an_7 = db.query(AnalysisSession.user_id).filter(
-            AnalysisSession.created_at >= since_7
-        ).distinct()
-        u7 = set(r[0] for r in pay_7.all()) | set(r[0] for r in an_7.all())
-        active_count_7 = len(u7)
-        pay_30 = db.query(Payment.user_id).filter(
-            Payment.status == "completed", Payment.completed_at >= since
-        ).distinct()
-        an_30 = db.query(AnalysisSession.user_id).filter(
-            AnalysisSession.created_at >= since
-        ).distinct()
-        u30 = set(r[0] for r in pay_30.all()) | set(r[0] for r in an_30.all())
-        active_count_30 = len(u30)
-    except Exception:
-        active_count_7 = 0
-        active_count_30 = 0
-
-    # Referrals
-    total_referrals = db.query(Referral).count()
-    total_bonus_given = (
-        db.query(func.sum(Referral.bonus_requests)).scalar() or 0
+    tariff_counts = _tariff_counts(db)
+
+    # All three daily series in one round-trip: UNION ALL with a series
+    # discriminator. date_trunc buckets server-side without the per-row
+    # CAST-to-Date that defeats the created_at indexes.
+    user_day = func.date_trunc("day", User.created_at)
+    analysis_day = func.date_trunc("day", AnalysisSession.created_at)
+    payment_day = func.date_trunc(
+        "day",
+        func.coalesce(Payment.payment_date, Payment.completed_at, Payment.created_at),
     )
-
-    # Notifications
-    notifications_created = db.query(UserNotification).count()
-    notifications_sent = db.query(UserNotification).filter(
-        UserNotification.sent == True
-    ).count()
-
-    # MRR approximation: active subscriptions * average price (simplified)
-    # We don't have per-plan price in DB; use completed payments last 30d sum / months equivalent
-    payments_last_30 = (
-        db.query(func.sum(Payment.amount))
-        .filter(
-            Payment.status == "completed",
-            Payment.completed_at >= since,
-        )
-        .scalar()
-        or 0
-    )
-    revenue_30d = float(payments_last_30)
-
-    return {
+    series_stmt = union_all(
+        select(literal("users").label("series"), user_day.label("day"), func.count(User.id).label("value"))
+        .where(User.created_at >= since)
+        .group_by(user_day),
+        select(literal("analyses").label("series"), analysis_day.label("day"), func.count(AnalysisSession.id).label("value"))
+        .where(AnalysisSession.created_at >= since)
+        .group_by(analysis_day),
+        select(literal("revenue").label("series"), payment_day.label("day"), func.sum(Payment.amount).label("value"))
+        .where(completed, Payment.completed_at >= since)
+        .group_by(payment_day),
+    ).order_by("day")
+    users_daily, analyses_daily, revenue_daily = [], [], []
+    for series, day, value in db.execute(series_stmt):
+        if series == "users":
+            users_daily.append({"date": day.date().isoformat(), "count": value})
+        elif series == "analyses":
+            analyses_daily.append({"date": day.date().isoformat(), "count": value})
+        else:
+            revenue_daily.append({"date": day.date().isoformat(), "amount": float(value)})
+
+    return _cache_put(f"dashboard:{days}", {
         "overview": {
-            "total_users": total_users,
-            "active_subscriptions": active_subs,
-            "total_analyses": total_analyses,
-            "total_revenue": float(total_revenue),
-            "paid_users": paid_users,
+            "total_users": o.total_users,
+            "active_subscriptions": o.active_subs,
+            "total_analyses": o.total_analyses,
+            "total_revenue": float(o.total_revenue),
+            "paid_users": o.paid_users,
             "conversion_rate_percent": round(conversion, 1),
-            "basic_active": basic_active,
-            "premium_active": premium_active,
+            "basic_active": o.basic_active,
+            "premium_active": o.premium_active,
             "tariff_counts": tariff_counts,
-            "active_users_7d": active_count_7,
-            "active_users_30d": active_count_30,
-            "referrals_total": total_referrals,
-            "referrals_bonus_requests": int(total_bonus_given),
-            "notifications_created": notifications_created,
-            "notifications_sent": notifications_sent,
-            "revenue_last_30d": revenue_30d,
+            "active_users_7d": active_7d,
+            "active_users_30d": active_30d,
+            "referrals_total": o.total_referrals,
+            "referrals_bonus_requests": int(o.total_bonus_given),
+            "notifications_created": o.notifications_created,
+            "notifications_sent": o.notifications_sent,
+            "revenue_last_30d": float(o.revenue_30d),
         },
         "series": {
             "users_daily": users_daily,
@@ -256,264 +235,260 @@ async def get_dashboard(
             "revenue_daily": revenue_daily,
         },
         "days": days,
-    }
+    })
 
 
 @app.get("/stats/overview")
-async def get_overview(
+def get_overview(
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Get overview statistics."""
-    total_users = db.query(User).count()
-
-    active_subscriptions = db.query(User).filter(
-        User.subscription_status == "active",
-        User.subscription_expire_at > datetime.utcnow(),
-    ).count()
+    cached = _cache_get("overview")
+    if cached is not None:
+        return cached
 
-    total_analyses = db.query(AnalysisSession).count()
+    now = datetime.utcnow()
 
-    total_revenue = (
-        db.query(func.sum(Payment.amount)).filter(Payment.status == "completed").scalar()
-        or 0
+    # Monotonic totals come from the precomputed snapshot when fresh (full-table
+    # aggregates otherwise get slower as the tables grow); the time-dependent
+    # active count is always computed live against the indexed columns.
+    summary = (
+        db.query(DashboardSummary)
+        .order_by(DashboardSummary.asof.desc())
+        .first()
     )
-
-    return {
-        "total_users": total_users,
-        "active_subscriptions": active_subscriptions,
-        "total_analyses": total_analyses,
-        "total_revenue": float(total_revenue),
-    }
+    if summary and summary.asof > now - timedelta(minutes=10):
+        active_subscriptions = db.query(User).filter(User.active_filter(now)).count()
+        return _cache_put("overview", {
+            "total_users": summary.total_users,
+            "active_subscriptions": active_subscriptions,
+            "total_analyses": summary.total_analyses,
+            "total_revenue": float(summary.total_revenue),
+        })
+
+    row = db.execute(select(
+        select(func.count(User.id)).scalar_subquery().label("total_users"),
+        select(func.count(User.id)).where(
+            User.active_filter(now)
+        ).scalar_subquery().label("active_subscriptions"),
+        select(func.count(AnalysisSession.id)).scalar_subquery().label("total_analyses"),
+        select(func.coalesce(func.sum(Payment.amount), 0)).where(
+            Payment.status == "completed"
+        ).scalar_subquery().label("total_revenue"),
+    )).one()
+
+    return _cache_put("overview", {
+        "total_users": row.total_users,
+        "active_subscriptions": row.active_subscriptions,
+        "total_analyses": row.total_analyses,
+        "total_revenue": float(row.total_revenue),
+    })
 
 
 @app.get("/stats/users/daily")
-async def get_users_daily(
+def get_users_daily(
     days: int = Query(30, ge=1, le=90),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """New registrations per day."""
     since = _days_ago(days)
+    day = func.date_trunc("day", User.created_at)
     rows = (
-        db.query(cast(User.created_at, Date), func.count(User.id))
+        db.query(day, func.count(User.id))
         .filter(User.created_at >= since)
-        .group_by(cast(User.created_at, Date))
-        .order_by(cast(User.created_at, Date))
+        .group_by(day)
+        .order_by(day)
         .all()
     )
-    return [{"date": d.isoformat(), "count": c} for d, c in rows]
+    return [{"date": d.date().isoformat(), "count": c} for d, c in rows]
 
 
 @app.get("/stats/analyses/daily")
-async def get_analyses_daily(
+def get_analyses_daily(
     days: int = Query(30, ge=1, le=90),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Analyses uploaded per day."""
     since = _days_ago(days)
+    day = func.date_trunc("day", AnalysisSession.created_at)
     rows = (
-        db.query(cast(AnalysisSession.created_at, Date), func.count(AnalysisSession.id))
+        db.query(day, func.count(AnalysisSession.id))
         .filter(AnalysisSession.created_at >= since)
-        .group_by(cast(AnalysisSession.created_at, Date))
-        .order_by(cast(AnalysisSession.created_at, Date))
+        .group_by(day)
+        .order_by(day)
         .all()
     )
-    return [{"date": d.isoformat(), "count": c} for d, c in rows]
+    return [{"date": d.date().isoformat(), "count": c} for d, c in rows]
 
 
 @app.get("/stats/revenue/daily")
-async def get_revenue_daily(
+def get_revenue_daily(
     days: int = Query(30, ge=1, le=90),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Revenue per day (completed payments)."""
     since = _days_ago(days)
+    day = func.date_trunc(
+        "day",
+        func.coalesce(Payment.payment_date, Payment.completed_at, Payment.created_at),
+    )
     rows = (
-        db.query(
-            func.coalesce(
-                cast(Payment.payment_date, Date),
-                cast(Payment.completed_at, Date),
-                cast(Payment.created_at, Date),
-            ),
-            func.sum(Payment.amount),
-        )
+        db.query(day, func.sum(Payment.amount))
         .filter(Payment.status == "completed", Payment.completed_at >= since)
-        .group_by(
-            func.coalesce(
-                cast(Payment.payment_date, Date),
-                cast(Payment.completed_at, Date),
-                cast(Payment.created_at, Date),
-            )
-        )
-        .order_by(
-            func.coalesce(
-                cast(Payment.payment_date, Date),
-                cast(Payment.completed_at, Date),
-                cast(Payment.created_at, Date),
-            )
-        )
+        .group_by(day)
+        .order_by(day)
         .all()
     )
-    return [{"date": d.isoformat(), "amount": float(s)} for d, s in rows]
+    return [{"date": d.date().isoformat(), "amount": float(s)} for d, s in rows]
 
 
 @app.get("/stats/plans")
-async def get_plans_stats(
+def get_plans_stats(
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Active subscriptions by plan (basic/premium)."""
+    cached = _cache_get("plans")
+    if cached is not None:
+        return cached
+
     now = datetime.utcnow()
-    basic = (
-        db.query(User)
-        .filter(
-            User.subscription_status == "active",
-            User.subscription_expire_at > now,
-            User.subscription_plan == "basic",
-        )
-        .count()
-    )
-    premium = (
-        db.query(User)
-        .filter(
-            User.subscription_status == "active",
-            User.subscription_expire_at > now,
-            User.subscription_plan == "premium",
-        )
-        .count()
-    )
-    return {"basic_active": basic, "premium_active": premium}
+    active = User.active_filter(now)
+    row = db.execute(select(
+        select(func.count(User.id)).where(active, User.subscription_plan == "basic").scalar_subquery().label("basic"),
+        select(func.count(User.id)).where(active, User.subscription_plan == "premium").scalar_subquery().label("premium"),
+    )).one()
+    return _cache_put("plans", {"basic_active": row.basic, "premium_active": row.premium})
 
 
 @app.get("/stats/conversion")
-async def get_conversion(
+def get_conversion(
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Conversion: paid users / total users."""
-    total = db.query(User).count()
-    paid = (
-        db.query(func.count(distinct(Payment.user_id)))
-        .filter(Payment.status == "completed")
-        .scalar()
-        or 0
-    )
-    return {
+    cached = _cache_get("conversion")
+    if cached is not None:
+        return cached
+
+    row = db.execute(select(
+        select(func.count(User.id)).scalar_subquery().label("total"),
+        select(func.count(User.id)).where(
+            User.has_paid == True
+        ).scalar_subquery().label("paid"),
+    )).one()
+    total, paid = row.total, row.paid
+    return _cache_put("conversion", {
         "total_users": total,
         "paid_users": paid,
         "conversion_rate_percent": round((paid / total * 100), 1) if total else 0,
-    }
+    })
 
 
 @app.get("/stats/referrals")
-async def get_referrals_stats(
+def get_referrals_stats(
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Referral program stats."""
-    total = db.query(Referral).count()
-    bonus = db.query(func.sum(Referral.bonus_requests)).scalar() or 0
-    return {"total_referrals": total, "total_bonus_requests": int(bonus)}
+    cached = _cache_get("referrals")
+    if cached is not None:
+        return cached
+
+    row = db.execute(select(
+        func.count(Referral.id).label("total"),
+        func.coalesce(func.sum(Referral.bonus_requests), 0).label("bonus"),
+    )).one()
+    return _cache_put("referrals", {"total_referrals": row.total, "total_bonus_requests": int(row.bonus)})
 
 
 @app.get("/users")
-async def get_users(
-    skip: int = 0,
-    limit: int = 100,
+def get_users(
+    after_id: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=500),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
-    """Get users list."""
-    users = db.query(User).offset(skip).limit(limit).all()
-
-    return [
-        {
-            "id": user.id,
-            "telegram_id": user.telegram_id,
-            "subscription_status": user.subscription_status,
-            "subscription_expire_at": user.subscription_expire_at.isoformat()
-            if user.subscription_expire_at
-            else None,
-            "created_at": user.created_at.isoformat(),
-        }
-        for user in users
-    ]
+    """Get users list (keyset-paginated: pass next_cursor as after_id)."""
+    stmt = select(
+        User.id,
+        User.telegram_id,
+        User.subscription_status,
+        User.subscription_expire_at,
+        User.created_at,
+    ).order_by(User.id.desc())
+    if after_id is not None:
+        stmt = stmt.where(User.id < after_id)
+    # RowMappings serialize as dicts directly — no per-attribute Python work.
+    rows = db.execute(stmt.limit(limit)).mappings().all()
+
+    return {
+        "items": rows,
+        "next_cursor": rows[-1]["id"] if len(rows) == limit else None,
+    }
 
 
 @app.get("/payments")
-async def get_payments(
-    skip: int = 0,
-    limit: int = 100,
+def get_payments(
+    after_id: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=500),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
-    """Get payments list."""
-    payments = (
-        db.query(Payment)
-        .order_by(Payment.created_at.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
-    )
+    """Get payments list (keyset-paginated: pass next_cursor as after_id)."""
+    stmt = select(
+        Payment.id,
+        Payment.user_id,
+        # Cast Numeric→float in SQL instead of float() per row in Python
+        cast(Payment.amount, Float).label("amount"),
+        Payment.tariff,
+        Payment.status,
+        Payment.yookassa_payment_id,
+        Payment.created_at,
+        Payment.completed_at,
+    ).order_by(Payment.id.desc())
+    if after_id is not None:
+        stmt = stmt.where(Payment.id < after_id)
+    rows = db.execute(stmt.limit(limit)).mappings().all()
 
-    return [
-        {
-            "id": payment.id,
-            "user_id": payment.user_id,
-            "amount": float(payment.amount),
-            "tariff": payment.tariff,
-            "status": payment.status,
-            "yookassa_payment_id": payment.yookassa_payment_id,
-            "created_at": payment.created_at.isoformat(),
-            "completed_at": payment.completed_at.isoformat()
-            if payment.completed_at
-            else None,
-        }
-        for payment in payments
-    ]
+    return {
+        "items": rows,
+        "next_cursor": rows[-1]["id"] if len(rows) == limit else None,
+    }
 
 
 @app.get("/analyses")
-async def get_analyses(
-    skip: int = 0,
-    limit: int = 100,
+def get_analyses(
+    after_id: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=500),
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
-    """Get analyses list."""
-    analyses = (
-        db.query(AnalysisSession)
-        .order_by(AnalysisSession.created_at.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
-    )
+    """Get analyses list (keyset-paginated: pass next_cursor as after_id)."""
+    stmt = select(
+        AnalysisSession.id,
+        AnalysisSession.user_id,
+        AnalysisSession.created_at,
+    ).order_by(AnalysisSession.id.desc())
+    if after_id is not None:
+        stmt = stmt.where(AnalysisSession.id < after_id)
+    rows = db.execute(stmt.limit(limit)).mappings().all()
 
-    return [
-        {
-            "id": analysis.id,
-            "user_id": analysis.user_id,
-            "created_at": analysis.created_at.isoformat(),
-        }
-        for analysis in analyses
-    ]
+    return {
+        "items": rows,
+        "next_cursor": rows[-1]["id"] if len(rows) == limit else None,
+    }
 
 
 @app.get("/stats/subscriptions")
-async def get_subscription_stats(
+def get_subscription_stats(
     db: Session = Depends(get_db),
     token: str = Depends(verify_admin_token),
 ):
     """Get subscription statistics (payments by tariff)."""
-    stats = {}
-    for plan in ["1month", "3months", "6months", "12months"]:
-        count = (
-            db.query(Payment)
-            .filter(Payment.tariff == plan, Payment.status == "completed")
-            .count()
-        )
-        stats[plan] = count
-    return stats
+    counts = _tariff_counts(db)
+    return {plan: counts.get(plan, 0) for plan in ["1month", "3months", "6months", "12months"]}
@@ -24,18 +24,28 @@
 """
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from sqlalchemy.orm import Session
-from database import User, AnalysisSession, StructuredResult, FollowUpQuestion, UserNotification
+from sqlalchemy import func
+from sqlalchemy.orm import Session, joinedload
+from database import SessionLocal, User, AnalysisSession, StructuredResult, FollowUpQuestion, UserNotification
 from subscription import SubscriptionManager
 from payment import PaymentService
-from file_processor import FileProcessor
-from llm_service import LLMService
-from redis_client import FSMStorage
+from llm_service import LLMService, LLMCache
+from redis_client import FSMStorage, ActivityTracker, redis_client, redis_available
+from cleanup import cleanup_user_analyses
 from loguru import logger
+from functools import lru_cache
 import asyncio
-from datetime import datetime
+import io
+import os
+import re
+import textwrap
+import time
+from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
+# Уведомления принимаются и показываются по Москве — зона одна на процесс
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+
 try:
     from faq_analyses import search_faq
 except Exception:
@@ -43,6 +53,212 @@ except Exception:
 
 ADMIN_ID = 565638442
 
+# admin_grant_<plan>_<id> / admin_remove_<id> разбираются одним
+# предкомпилированным выражением вместо цепочки startswith + rsplit.
+_ADMIN_CB_RE = re.compile(r"^admin_(?:grant_(\w+?)|remove)_(\d+)$")
+
+# Паттерны парсеров даты/времени уведомлений компилируются один раз на
+# процесс, а не заново на каждое сообщение в диалоге.
+_NOTIF_DATE_SEP_RE = re.compile(r"[,.\-/]")
+_WS_RE = re.compile(r"\s+")
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def _scan_two_ints(s: str) -> tuple[int, int, int]:
+    """Возвращает (a, b, сколько чисел найдено) — первые два числа строки.
+
+    Ввод времени — крошечные строки вида «14:30» или «в 5»; один проход по
+    символам дешевле re.findall со списком токенов и int() на каждый.
+    """
+    a = b = cur = 0
+    count = 0
+    in_digits = False
+    for ch in s:
+        if "0" <= ch <= "9":
+            cur = cur * 10 + (ord(ch) - 48)
+            in_digits = True
+        elif in_digits:
+            if count == 0:
+                a = cur
+            else:
+                b = cur
+            count += 1
+            cur = 0
+            in_digits = False
+            if count == 2:
+                return a, b, count
+    if in_digits:
+        if count == 0:
+            a = cur
+        else:
+            b = cur
+        count += 1
+    return a, b, count
+
+# Ответы, после которых задаём вопрос о беременности. casefold вместо lower —
+# корректно схлопывает «ЖЕНСКИЙ» и прочие варианты регистра.
+_FEMALE_VALUES = frozenset(("female", "f", "ж", "женский"))
+
+# Ограничение на одновременные CPU-тяжёлые обработки файлов (PDF/OCR),
+# чтобы всплеск загрузок не забил пул потоков и ядра.
+_PROCESSING_SEMAPHORE = asyncio.Semaphore(os.cpu_count() or 2)
+
+# Одновременные генерации в LLM: каждая занимает поток из пула на секунды,
+# всплеск завершённых диалогов не должен выедать пул целиком — лишние
+# ждут здесь, пользователь в это время уже видит «Генерирую отчёт…».
+_LLM_SEMAPHORE = asyncio.Semaphore(4)
+
+
+class _SendThrottle:
+    """Глобальный ограничитель исходящих вызовов Telegram API.
+
+    Бот упирается в ~30 сообщений/сек на всех пользователей; при всплеске
+    нажатий лишние вызовы не копятся у Telegram (RetryAfter), а ждут свой
+    слот в очереди здесь. Счётчик секунды живёт в Redis (INCR + EX), поэтому
+    лимит общий для всех процессов бота; без Redis работает локальный
+    token bucket — обычный для проекта fallback. Burst до полной ёмкости
+    позволяет тихим периодам накапливать запас: одиночное нажатие после
+    паузы уходит мгновенно, а не ждёт начала «своей» секунды.
+
+    Дополнительно Telegram режет ~1 сообщение/сек в один чат — на это есть
+    второй уровень: per-chat bucket (1/с, burst 3, чтобы многокусочный
+    отчёт уходил без искусственной паузы между первыми частями).
+    """
+
+    _CHAT_RATE = 1.0
+    _CHAT_BURST = 3.0
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._tokens = float(rate)
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+        # chat_id -> [остаток токенов, момент последнего пополнения]
+        self._chats: dict[int, list[float]] = {}
+
+    def _acquire_redis(self) -> bool | None:
+        """True/False — слот получен/секунда исчерпана; None — Redis недоступен."""
+        if not redis_available or not redis_client:
+            return None
+        try:
+            pipe = redis_client.pipeline()
+            key = f"tg:out:{int(time.time())}"
+            pipe.incr(key)
+            pipe.expire(key, 2)
+            current, _ = pipe.execute()
+            return int(current) <= self.rate
+        except Exception as e:
+            logger.warning(f"Redis send throttle error: {e}, using local counter")
+            return None
+
+    async def _acquire_chat(self, chat_id: int):
+        """Пейсинг одного чата; работает без локa — loop однопоточный."""
+        while True:
+            now = time.monotonic()
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = [self._CHAT_BURST, now]
+                if len(self._chats) > 512:
+                    # Забытые чаты: ведро, полное больше минуты, уже не пейсит
+                    stale = [cid for cid, b in self._chats.items() if now - b[1] > 60]
+                    for cid in stale:
+                        self._chats.pop(cid, None)
+            tokens = min(self._CHAT_BURST, bucket[0] + (now - bucket[1]) * self._CHAT_RATE)
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                return
+            bucket[0] = tokens
+            await asyncio.sleep((1.0 - tokens) / self._CHAT_RATE)
+
+    async def acquire(self, chat_id: int | None = None):
+        if chat_id is not None:
+            await self._acquire_chat(chat_id)
+        async with self._lock:
+            while True:
+                got = await asyncio.to_thread(self._acquire_redis)
+                if got:
+                    return
+                if got is None:
+                    now = time.monotonic()
+                    self._tokens = min(float(self.rate), self._tokens + (now - self._stamp) * self.rate)
+                    self._stamp = now
+                    if self._tokens < 1.0:
+                        await asyncio.sleep((1.0 - self._tokens) / self.rate)
+                        self._tokens = 1.0
+                        self._stamp = time.monotonic()
+                    self._tokens -= 1.0
+                    return
+                # Секунда исчерпана всеми процессами — ждём следующую
+                await asyncio.sleep(1 - (time.time() % 1))
+
+
+_send_throttle = _SendThrottle(28)
+
+# Сервисы не держат состояние конкретного пользователя, а BotHandlers
+# создаётся на каждый update — клиент OpenAI и процессор файлов строятся
+# один раз на процесс, причём лениво: file_processor тянет PyMuPDF и
+# tesseract, и пользователям, которые не загружают файлы, этот импорт
+# не нужен вовсе.
+_LLM_SERVICE = None
+_LLM_INIT_FAILED = False
+_FILE_PROCESSOR = None
+_FP_INIT_FAILED = False
+
+
+def _get_llm_service():
+    global _LLM_SERVICE, _LLM_INIT_FAILED
+    if _LLM_SERVICE is None and not _LLM_INIT_FAILED:
+        try:
+            _LLM_SERVICE = LLMService()
+        except Exception as e:
+            logger.error(f"LLM service init failed: {e}")
+            _LLM_INIT_FAILED = True
+    return _LLM_SERVICE
+
+
+def _get_file_processor():
+    global _FILE_PROCESSOR, _FP_INIT_FAILED
+    if _FILE_PROCESSOR is None and not _FP_INIT_FAILED:
+        try:
+            from file_processor import FileProcessor
+            _FILE_PROCESSOR = FileProcessor()
+        except Exception as e:
+            logger.error(f"File processor init failed: {e}")
+            _FP_INIT_FAILED = True
+    return _FILE_PROCESSOR
+
+# Фоновые извлечения по telegram_id: OCR и LLM-извлечение не зависят от
+# ответов анкеты, поэтому идут параллельно с ней — к последнему ответу
+# session_id обычно уже готов.
+_PENDING_EXTRACTIONS: dict[int, asyncio.Task] = {}
+
+
+async def _extract_in_background(buf: io.BytesIO, mime: str, telegram_id: int) -> int:
+    """OCR + извлечение + запись сессии; возвращает id созданной сессии.
+
+    Задача переживает update, в котором пришёл файл, поэтому работает со
+    своей сессией БД — как cleanup_user_analyses.
+    """
+    async with _PROCESSING_SEMAPHORE:
+        raw = await asyncio.to_thread(_get_file_processor().process_file, buf, mime)
+    async with _LLM_SEMAPHORE:
+        data = await asyncio.to_thread(_get_llm_service().extract_structured_data, raw)
+
+    def _persist() -> int:
+        db = SessionLocal()
+        try:
+            user = db.query(User).filter(User.telegram_id == telegram_id).first()
+            session = AnalysisSession(user_id=user.id)
+            session.structured_result = StructuredResult(structured_json=data)
+            db.add(session)
+            db.commit()
+            return session.id
+        finally:
+            db.close()
+
+    return await asyncio.to_thread(_persist)
+
 # Профессиональные тексты экранов (без маркетинговой и ИИ-размытости)
 class T:
     # Общие
@@ -264,36 +480,178 @@ MSG_NEED_START = T.NEED_START
 MSG_NEED_SUB = T.NEED_SUB
 MSG_ERR = T.ERR_TRY_AGAIN
 
+# Статические клавиатуры собираются один раз при импорте: содержимое не зависит
+# от пользователя, а пересоздание кнопок на каждое нажатие — лишние аллокации.
+_MENU_TAIL = [
+    [InlineKeyboardButton("❓ Как пользоваться", callback_data="how_to_use")],
+    [InlineKeyboardButton("💳 Подписка", callback_data="subscription")],
+    [InlineKeyboardButton("🎁 Программа лояльности", callback_data="loyalty")],
+    [InlineKeyboardButton("🆘 Помощь", callback_data="help")],
+    [InlineKeyboardButton("ℹ️ О сервисе", callback_data="about")],
+]
+_MAIN_MENU_PREMIUM = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")],
+    [InlineKeyboardButton("📤 Загрузить анализ", callback_data="upload_analysis")],
+    [InlineKeyboardButton("💬 Спросить Pulse", callback_data="ask_pulse")],
+    [InlineKeyboardButton("📊 Сравнить", callback_data="compare_analyses")],
+    [InlineKeyboardButton("📁 Мои анализы", callback_data="recent_analyses")],
+    [InlineKeyboardButton("🔔 Уведомления", callback_data="notifications")],
+    *_MENU_TAIL,
+])
+_MAIN_MENU_BASIC = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")],
+    [InlineKeyboardButton("💬 Спросить Pulse", callback_data="ask_pulse")],
+    [InlineKeyboardButton("📊 Сравнить", callback_data="compare_analyses")],
+    [InlineKeyboardButton("📁 Мои анализы", callback_data="recent_analyses")],
+    *_MENU_TAIL,
+])
+_MAIN_MENU_INACTIVE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Подписка", callback_data="subscription")],
+    [InlineKeyboardButton("🎁 Программа лояльности", callback_data="loyalty")],
+    [InlineKeyboardButton("🆘 Помощь", callback_data="help")],
+    [InlineKeyboardButton("ℹ️ О сервисе", callback_data="about")],
+])
+_TERMS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(T.TERMS_BTN, callback_data="terms")],
+    [InlineKeyboardButton(T.ACCEPT_BTN, callback_data="accept_terms")],
+])
+_PLANS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📌 Базовая 1 мес — 199 ₽", callback_data="plan_1month_basic")],
+    [InlineKeyboardButton("📌 Базовая 3 мес — 499 ₽", callback_data="plan_3months_basic")],
+    [InlineKeyboardButton("📌 Базовая 6 мес — 899 ₽", callback_data="plan_6months_basic")],
+    [InlineKeyboardButton("📌 Базовая 12 мес — 1499 ₽", callback_data="plan_12months_basic")],
+    [InlineKeyboardButton("⭐ Премиум 1 мес — 299 ₽", callback_data="plan_1month_premium")],
+    [InlineKeyboardButton("⭐ Премиум 3 мес — 799 ₽", callback_data="plan_3months_premium")],
+    [InlineKeyboardButton("⭐ Премиум 6 мес — 1399 ₽", callback_data="plan_6months_premium")],
+    [InlineKeyboardButton("⭐ Премиум 12 мес — 2499 ₽", callback_data="plan_12months_premium")],
+    [InlineKeyboardButton(T.BACK, callback_data="subscription")],
+])
+_LOYALTY_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(T.LOYALTY_GET_LINK_BTN, callback_data="get_referral_link")],
+    [InlineKeyboardButton(T.LOYALTY_STATS_BTN, callback_data="referral_stats")],
+    [InlineKeyboardButton(T.BACK, callback_data="back_menu")],
+])
+# Одно-кнопочные «Назад»/«Подписка» — самые частые клавиатуры в боте.
+_KB_BACK_MENU = InlineKeyboardMarkup([[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+_KB_BACK_LOYALTY = InlineKeyboardMarkup([[InlineKeyboardButton(T.BACK, callback_data="loyalty")]])
+_KB_BACK_NOTIFICATIONS = InlineKeyboardMarkup([[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+_KB_SUBSCRIPTION = InlineKeyboardMarkup([[InlineKeyboardButton("💳 Подписка", callback_data="subscription")]])
+
+# Тексты статичных экранов: не зависят от пользователя, поэтому заголовок и
+# тело склеиваются один раз при импорте, а не f-строкой на каждый показ.
+_TXT_ADMIN_PANEL = f"{T.ADMIN_PANEL}\n\n{T.ADMIN_CHOOSE}"
+_TXT_TERMS_FULL = f"{T.TERMS_TITLE}\n\n{T.TERMS_FULL}"
+_TXT_ABOUT = f"{T.ABOUT_TITLE}\n\n{T.ABOUT_BODY}"
+_TXT_SUB_INACTIVE = f"{T.SUB_STATUS_TITLE}\n\n{T.SUB_NO_ACTIVE}\n\n{T.SUB_WHAT_INCLUDED}"
+_TXT_PLANS = (
+    f"{T.SUB_PLANS_TITLE}\n\n"
+    "📌 Базовая — только «Спросить Pulse», без загрузки анализов и уведомлений.\n"
+    "⭐ Премиум — загрузка анализов, уведомления, «Спросить Pulse» без лимита.\n"
+)
+_TXT_LOYALTY = f"{T.LOYALTY_TITLE}\n\n{T.LOYALTY_RULES}"
+_TXT_HOW_TO_USE = f"{T.HOW_TO_USE_TITLE}\n\n{T.HOW_TO_USE_BODY}"
+_TXT_HELP = f"{T.HELP_TITLE}\n\n{T.HELP_BODY}"
+_TXT_NOTIFICATIONS = f"{T.NOTIFICATIONS_TITLE}\n\n{T.NOTIFICATIONS_DESC}"
+_TXT_ASK_PULSE = f"{T.ASK_PULSE_PROMPT}\n\n{T.ASK_PULSE_HINT}"
+_TXT_UPLOAD = f"{T.UPLOAD_TITLE}\n\n{T.UPLOAD_DISCLAIMER}\n\n{T.UPLOAD_PROMPT}"
+_TXT_CONTEXT_AGE = f"{T.CONTEXT_TITLE}\n\n{T.CONTEXT_AGE}"
+_TXT_RECENT_EMPTY = f"{T.RECENT_TITLE}\n\n{T.RECENT_EMPTY}"
+_TXT_COMPARE_CHOOSE = f"{T.COMPARE_TITLE}\n\n{T.COMPARE_CHOOSE_PAIR}"
+
+
+@lru_cache(maxsize=1024)
+def _session_actions_kb(sid: int) -> InlineKeyboardMarkup:
+    """Стандартные действия после отчёта (Сравнить/Уточнить/Загрузить/В меню).
+
+    Одна и та же клавиатура собиралась в нескольких местах на каждое нажатие;
+    кэш по id сессии переиспользует готовый markup.
+    """
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("📊 Сравнить", callback_data=f"compare_from_{sid}"),
+            InlineKeyboardButton("❓ Уточнить", callback_data=f"follow_up_{sid}"),
+        ],
+        [InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")],
+        [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")],
+    ])
+
 
 class BotHandlers:
     def __init__(self, db: Session):
         self.db = db
-        try:
-            self.llm_service = LLMService()
-        except Exception:
-            self.llm_service = None
-        try:
-            self.file_processor = FileProcessor()
-        except Exception:
-            self.file_processor = None
+        # BotHandlers создаётся на один update, поэтому кэш живёт ровно один запрос:
+        # повторные _user() внутри одного обработчика не ходят в БД.
+        self._user_cache: dict = {}
+
+    # Ленивые синглтоны процесса: /help и навигация по меню не должны
+    # платить за инициализацию OpenAI-клиента и OCR-стека.
+    @property
+    def llm_service(self):
+        return _get_llm_service()
+
+    @property
+    def file_processor(self):
+        return _get_file_processor()
 
     async def _reply(self, update: Update, text: str, keyboard=None):
-        markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=markup)
+        if isinstance(keyboard, InlineKeyboardMarkup):
+            markup = keyboard
+        else:
+            markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+        q = update.callback_query
+        if q:
+            # Повторное нажатие той же кнопки перерисовало бы тот же экран:
+            # Telegram ответит 400 «Message is not modified», а вызов всё
+            # равно спишется из лимита — сравниваем с текущим сообщением и
+            # не ходим в API зря.
+            msg = q.message
+            if msg and msg.text == text and msg.reply_markup == markup:
+                return
+            await _send_throttle.acquire(update.effective_chat.id if update.effective_chat else None)
+            await q.edit_message_text(text, reply_markup=markup)
         elif update.effective_message:
+            await _send_throttle.acquire(update.effective_chat.id if update.effective_chat else None)
             await update.effective_message.reply_text(text, reply_markup=markup)
 
+    async def _run_db(self, fn, *args):
+        """Выполняет блокирующую работу с БД в пуле потоков.
+
+        Сессия создаётся на один update, поэтому внутри задачи обращения к ней
+        последовательны — в поток уходит только ожидание round-trip к Postgres,
+        и event loop в это время обслуживает другие обновления.
+        """
+        return await asyncio.to_thread(fn, *args)
+
     def _user(self, telegram_id: int):
-        return self.db.query(User).filter(User.telegram_id == telegram_id).first()
+        user = self._user_cache.get(telegram_id)
+        if user is None:
+            user = self.db.query(User).filter(User.telegram_id == telegram_id).first()
+            if user:
+                self._user_cache[telegram_id] = user
+        return user
 
     async def _ensure_user(self, update: Update):
-        u = self._user(update.effective_user.id)
+        u = await self._run_db(self._user, update.effective_user.id)
         if u:
             return u
         await self._reply(update, MSG_NEED_START)
         return None
 
+    async def _ensure_active_user(self, update: Update):
+        """Пользователь + активная подписка одним вызовом.
+
+        Схлопывает пару _ensure_user + is_subscription_active, повторявшуюся
+        в каждом callback-хэндлере; сам пользователь мемоизирован в
+        _user_cache на время update, так что лишних запросов к БД нет.
+        """
+        user = await self._ensure_user(update)
+        if not user:
+            return None
+        if not SubscriptionManager.is_subscription_active(user):
+            await self._reply(update, MSG_NEED_SUB)
+            return None
+        return user
+
     def _is_admin(self, telegram_id: int) -> bool:
         return telegram_id == ADMIN_ID
 
@@ -304,20 +662,41 @@ class BotHandlers:
         await self._admin_dashboard(update)
 
     async def _admin_dashboard(self, update: Update):
-        text = f"{T.ADMIN_PANEL}\n\n{T.ADMIN_CHOOSE}"
+        text = _TXT_ADMIN_PANEL
         kb = [
             [InlineKeyboardButton("🔍 Поиск по ID", callback_data="admin_search_id")],
             [InlineKeyboardButton("👤 Поиск по username", callback_data="admin_search_username")],
         ]
-        if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-        else:
-            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await self._reply(update, text, kb)
+
+    async def _admin_mutate(self, update: Update, m: re.Match):
+        """Выдача/снятие подписки из карточки пользователя.
+
+        Принимает готовый match от _ADMIN_CB_RE: группа 1 — ключ тарифа
+        (None для admin_remove), группа 2 — id пользователя.
+        activate/deactivate возвращают обновлённого пользователя, поэтому
+        повторный SELECT перед перерисовкой карточки не нужен.
+        """
+        try:
+            plan_key, target_id = m.group(1), int(m.group(2))
+            if plan_key is None:
+                user = await self._run_db(SubscriptionManager.deactivate, self.db, target_id)
+                err = T.ERR_TRY_AGAIN
+            else:
+                user = await self._run_db(SubscriptionManager.activate_subscription, self.db, target_id, plan_key)
+                err = T.ADMIN_GRANT_ERR
+            if user:
+                await self._admin_user_card(update, user)
+            else:
+                await self._reply(update, err)
+        except (ValueError, AttributeError):
+            await self._reply(update, T.ERR_TRY_AGAIN)
 
     async def _admin_user_card(self, update: Update, user: User):
-        exp = user.subscription_expire_at.strftime("%Y-%m-%d") if user.subscription_expire_at else "—"
-        uname = getattr(user, "username", None) or "—"
-        plan = getattr(user, "subscription_plan", None) or "—"
+        # isoformat-срез в разы дешевле strftime (без разбора формат-строки)
+        exp = user.subscription_expire_at.isoformat()[:10] if user.subscription_expire_at else "—"
+        uname = user.username or "—"
+        plan = user.subscription_plan or "—"
         status_emoji = "✅" if user.subscription_status == "active" else "❌" if user.subscription_status == "inactive" else "⏰"
         text = (
             f"{T.ADMIN_USER_CARD}\n\n"
@@ -342,29 +721,38 @@ class BotHandlers:
         ]
         await self._reply(update, text, kb)
 
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        uid = update.effective_user.id
-        args = context.args or []
+    def _register_user(self, uid: int, args: list, username: str | None):
+        """Регистрация/обновление пользователя (блокирующая часть start).
+
+        Все изменения (referrer, referral_code, username) уходят одним commit:
+        один fsync WAL вместо трёх, реферальный код сразу в INSERT.
+        """
         user = self._user(uid)
+        code = args[0].upper() if args else None
+        # Пригласивший ищется не больше одного раза — и только когда код
+        # вообще может быть применён (новый пользователь или ещё без referrer).
+        ref = None
+        if code and (not user or not user.referrer_id):
+            ref = self.db.query(User).filter(User.referral_code == code).first()
         if not user:
             user = User(telegram_id=uid)
-            if args:
-                ref = self.db.query(User).filter(User.referral_code == (args[0].upper() if args else "")).first()
-                if ref:
-                    user.referrer_id = ref.id
-            self.db.add(user)
-            self.db.commit()
-        elif args and not user.referrer_id:
-            ref = self.db.query(User).filter(User.referral_code == args[0].upper()).first()
-            if ref and ref.id != user.id:
+            if ref:
                 user.referrer_id = ref.id
-                self.db.commit()
+            self.db.add(user)
+        elif ref and ref.id != user.id:
+            user.referrer_id = ref.id
         if not user.referral_code:
             user.generate_referral_code()
-            self.db.commit()
-        if update.effective_user.username and getattr(user, "username", None) != update.effective_user.username:
-            user.username = update.effective_user.username
-            self.db.commit()
+        if username and user.username != username:
+            user.username = username
+        self.db.commit()
+        self._user_cache[uid] = user
+        return user
+
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        uid = update.effective_user.id
+        args = context.args or []
+        await self._run_db(self._register_user, uid, args, update.effective_user.username)
         await self._show_terms(update)
 
     async def cmd_analyses(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -372,9 +760,7 @@ class BotHandlers:
         await self._recent_analyses(update)
 
     async def _show_terms(self, update: Update):
-        text = T.WELCOME
-        kb = [[InlineKeyboardButton(T.TERMS_BTN, callback_data="terms")], [InlineKeyboardButton(T.ACCEPT_BTN, callback_data="accept_terms")]]
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await update.message.reply_text(T.WELCOME, reply_markup=_TERMS_KB)
         FSMStorage.set_state(update.effective_user.id, States.START)
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -388,151 +774,109 @@ class BotHandlers:
                 return
             if data == "admin_search_id":
                 FSMStorage.set_state(uid, States.ADMIN_WAIT_ID)
-                await q.edit_message_text(T.ADMIN_SEARCH_ID)
+                await self._reply(update, T.ADMIN_SEARCH_ID)
                 return
             if data == "admin_search_username":
                 FSMStorage.set_state(uid, States.ADMIN_WAIT_USERNAME)
-                await q.edit_message_text(T.ADMIN_SEARCH_USERNAME)
+                await self._reply(update, T.ADMIN_SEARCH_USERNAME)
+                return
+            m = _ADMIN_CB_RE.match(data)
+            if m:
+                await self._admin_mutate(update, m)
                 return
-            for prefix, plan_key in [
-                ("admin_grant_1month_basic_", "1month_basic"),
-                ("admin_grant_3months_basic_", "3months_basic"),
-                ("admin_grant_1month_premium_", "1month_premium"),
-                ("admin_grant_3months_premium_", "3months_premium"),
-            ]:
-                if data.startswith(prefix):
-                    try:
-                        target_id = int(data.replace(prefix, ""))
-                        if SubscriptionManager.activate_subscription(self.db, target_id, plan_key):
-                            user = self.db.query(User).filter(User.id == target_id).first()
-                            await self._admin_user_card(update, user)
-                        else:
-                            await self._reply(update, T.ADMIN_GRANT_ERR)
-                    except (ValueError, AttributeError):
-                        await self._reply(update, T.ERR_TRY_AGAIN)
+
+        handler = self._CB_EXACT.get(data)
+        if handler:
+            await handler(self, update, context)
+            return
+        # Короткий проход по префиксам (payload срезается один раз);
+        # compare_from_ обязан стоять раньше compare_.
+        for prefix, prefix_handler, numeric in self._CB_PREFIX:
+            if data.startswith(prefix):
+                payload = data[len(prefix):]
+                # Дешёвая проверка вместо int() в try/except: битый payload
+                # (устаревшая или подделанная кнопка) просто игнорируется.
+                if numeric and not payload.isdigit():
                     return
-            if data.startswith("admin_remove_"):
-                try:
-                    target_id = int(data.replace("admin_remove_", ""))
-                    if SubscriptionManager.deactivate(self.db, target_id):
-                        user = self.db.query(User).filter(User.id == target_id).first()
-                        await self._admin_user_card(update, user)
-                    else:
-                        await self._reply(update, T.ERR_TRY_AGAIN)
-                except (ValueError, AttributeError):
-                    await self._reply(update, T.ERR_TRY_AGAIN)
+                await prefix_handler(self, update, context, payload)
                 return
 
-        if data == "terms":
-            kb = [[InlineKeyboardButton(T.BACK, callback_data="terms_back")]]
-            await q.edit_message_text(f"{T.TERMS_TITLE}\n\n{T.TERMS_FULL}", reply_markup=InlineKeyboardMarkup(kb))
-        elif data == "terms_back":
-            kb = [[InlineKeyboardButton(T.TERMS_BTN, callback_data="terms")], [InlineKeyboardButton(T.ACCEPT_BTN, callback_data="accept_terms")]]
-            await q.edit_message_text(T.WELCOME, reply_markup=InlineKeyboardMarkup(kb))
-        elif data == "accept_terms":
-            FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
-            await self._main_menu(update)
-        elif data == "back_menu":
-            FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
-            await self._main_menu(update)
-        elif data == "about":
-            await q.edit_message_text(f"{T.ABOUT_TITLE}\n\n{T.ABOUT_BODY}")
-        elif data == "how_to_use":
-            await self._how_to_use(update)
-        elif data == "help":
-            await self._help(update)
-        elif data == "ask_pulse":
-            await self._ask_pulse_request(update)
-        elif data == "subscription":
-            await self._subscription_status(update)
-        elif data == "subscription_plans":
-            await self._subscription_plans(update)
-        elif data == "loyalty":
-            await self._loyalty(update)
-        elif data == "get_referral_link":
-            await self._referral_link(update, context)
-        elif data == "referral_stats":
-            await self._referral_stats(update)
-        elif data == "upload_analysis":
-            await self._upload_request(update)
-        elif data == "compare_analyses":
-            await self._compare_request(update)
-        elif data == "recent_analyses":
-            await self._recent_analyses(update)
-        elif data.startswith("plan_"):
-            await self._payment(update, context, data.replace("plan_", ""))
-        elif data.startswith("analysis_"):
-            await self._analysis_detail(update, int(data.replace("analysis_", "")))
-        elif data.startswith("compare_from_"):
-            await self._compare_from(update, int(data.replace("compare_from_", "")))
-        elif data.startswith("compare_"):
-            parts = data.replace("compare_", "").split("_")
-            if len(parts) >= 2:
-                await self._do_compare(update, context, [int(parts[0]), int(parts[1])])
-        elif data.startswith("follow_up_"):
-            await self._follow_up_ask(update, context)
-        elif data.startswith("full_report_"):
-            await self._analysis_full_report(update, int(data.replace("full_report_", "")))
-        elif data == "profile":
-            await self._profile(update)
-        elif data == "notifications":
-            await self._notifications_menu(update)
-        elif data == "notifications_list":
-            await self._notifications_list(update)
-        elif data == "notification_create":
-            await self._notification_create_start(update)
-        elif data == "notification_confirm":
-            await self._notification_confirm(update)
-        elif data == "notification_cancel":
-            await self._notification_cancel(update)
-        elif data.startswith("notification_del_"):
-            await self._notification_delete(update, int(data.replace("notification_del_", "")))
+    async def _terms_view(self, update: Update):
+        kb = [[InlineKeyboardButton(T.BACK, callback_data="terms_back")]]
+        await self._reply(update, _TXT_TERMS_FULL, kb)
+
+    async def _terms_welcome(self, update: Update):
+        await self._reply(update, T.WELCOME, _TERMS_KB)
+
+    async def _to_main_menu(self, update: Update):
+        FSMStorage.set_state(update.effective_user.id, States.TERMS_ACCEPTED)
+        await self._main_menu(update)
+
+    async def _about(self, update: Update):
+        await self._reply(update, _TXT_ABOUT)
+
+    async def _do_compare_cb(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+        parts = payload.split("_")
+        if len(parts) >= 2 and parts[0].isdigit() and parts[1].isdigit():
+            await self._do_compare(update, context, [int(parts[0]), int(parts[1])])
+
+    # Диспетчеризация callback_data: точные совпадения за O(1) по словарю,
+    # затем короткий список префиксов вместо длинной цепочки if/elif.
+    _CB_EXACT = {
+        "terms": lambda self, u, c: self._terms_view(u),
+        "terms_back": lambda self, u, c: self._terms_welcome(u),
+        "accept_terms": lambda self, u, c: self._to_main_menu(u),
+        "back_menu": lambda self, u, c: self._to_main_menu(u),
+        "about": lambda self, u, c: self._about(u),
+        "how_to_use": lambda self, u, c: self._how_to_use(u),
+        "help": lambda self, u, c: self._help(u),
+        "ask_pulse": lambda self, u, c: self._ask_pulse_request(u),
+        "subscription": lambda self, u, c: self._subscription_status(u),
+        "subscription_plans": lambda self, u, c: self._subscription_plans(u),
+        "loyalty": lambda self, u, c: self._loyalty(u),
+        "get_referral_link": lambda self, u, c: self._referral_link(u, c),
+        "referral_stats": lambda self, u, c: self._referral_stats(u),
+        "upload_analysis": lambda self, u, c: self._upload_request(u),
+        "compare_analyses": lambda self, u, c: self._compare_request(u),
+        "recent_analyses": lambda self, u, c: self._recent_analyses(u),
+        "profile": lambda self, u, c: self._profile(u),
+        "notifications": lambda self, u, c: self._notifications_menu(u),
+        "notifications_list": lambda self, u, c: self._notifications_list(u),
+        "notification_create": lambda self, u, c: self._notification_create_start(u),
+        "notification_confirm": lambda self, u, c: self._notification_confirm(u),
+        "notification_cancel": lambda self, u, c: self._notification_cancel(u),
+    }
+    # Третий элемент — payload обязан состоять из цифр (id сессии/уведомления)
+    _CB_PREFIX = (
+        ("plan_", lambda self, u, c, p: self._payment(u, c, p), False),
+        ("analysis_", lambda self, u, c, p: self._analysis_detail(u, int(p)), True),
+        ("compare_from_", lambda self, u, c, p: self._compare_from(u, int(p)), True),
+        ("compare_", lambda self, u, c, p: self._do_compare_cb(u, c, p), False),
+        ("follow_up_", lambda self, u, c, p: self._follow_up_ask(u, c, p), True),
+        ("full_report_", lambda self, u, c, p: self._analysis_full_report(u, int(p)), True),
+        ("notification_del_", lambda self, u, c, p: self._notification_delete(u, int(p)), True),
+    )
 
     async def _main_menu(self, update: Update):
         uid = update.effective_user.id
-        user = self._user(uid)
-        active = user and SubscriptionManager.is_subscription_active(user)
-        if active:
-            plan = getattr(user, "subscription_plan", None) or "basic"
-            kb = [[InlineKeyboardButton("👤 Мой профиль", callback_data="profile")]]
-            if plan == "premium":
-                kb.append([InlineKeyboardButton("📤 Загрузить анализ", callback_data="upload_analysis")])
-            kb.append([InlineKeyboardButton("💬 Спросить Pulse", callback_data="ask_pulse")])
-            if plan == "premium":
-                kb.append([InlineKeyboardButton("📊 Сравнить", callback_data="compare_analyses")])
-                kb.append([InlineKeyboardButton("📁 Мои анализы", callback_data="recent_analyses")])
-                kb.append([InlineKeyboardButton("🔔 Уведомления", callback_data="notifications")])
-            else:
-                kb.append([InlineKeyboardButton("📊 Сравнить", callback_data="compare_analyses")])
-                kb.append([InlineKeyboardButton("📁 Мои анализы", callback_data="recent_analyses")])
-            kb.extend([
-                [InlineKeyboardButton("❓ Как пользоваться", callback_data="how_to_use")],
-                [InlineKeyboardButton("💳 Подписка", callback_data="subscription")],
-                [InlineKeyboardButton("🎁 Программа лояльности", callback_data="loyalty")],
-                [InlineKeyboardButton("🆘 Помощь", callback_data="help")],
-                [InlineKeyboardButton("ℹ️ О сервисе", callback_data="about")],
-            ])
+        user = await self._run_db(self._user, uid)
+        if user and SubscriptionManager.is_subscription_active(user):
+            plan = user.subscription_plan or "basic"
+            markup = _MAIN_MENU_PREMIUM if plan == "premium" else _MAIN_MENU_BASIC
         else:
-            kb = [
-                [InlineKeyboardButton("💳 Подписка", callback_data="subscription")],
-                [InlineKeyboardButton("🎁 Программа лояльности", callback_data="loyalty")],
-                [InlineKeyboardButton("🆘 Помощь", callback_data="help")],
-                [InlineKeyboardButton("ℹ️ О сервисе", callback_data="about")],
-            ]
+            markup = _MAIN_MENU_INACTIVE
         msg = T.MENU_CHOOSE
-        if update.callback_query:
-            await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
-        else:
-            await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+        await self._reply(update, msg, markup)
 
     async def _profile(self, update: Update):
         user = await self._ensure_user(update)
         if not user:
             return
-        plan = getattr(user, "subscription_plan", None) or "basic"
+        plan = user.subscription_plan or "basic"
         plan_name = T.PROFILE_PLAN_PREMIUM if plan == "premium" else T.PROFILE_PLAN_BASIC
         if SubscriptionManager.is_subscription_active(user):
-            exp = user.subscription_expire_at.strftime("%d.%m.%Y") if user.subscription_expire_at else "—"
+            e = user.subscription_expire_at
+            exp = f"{e.day:02d}.{e.month:02d}.{e.year}" if e else "—"
             lines = [
                 T.PROFILE_TITLE,
                 "",
@@ -541,11 +885,11 @@ class BotHandlers:
                 "",
             ]
             if plan == "premium":
-                rem, tot, bonus, used_up = SubscriptionManager.get_available_requests(user)
+                rem, tot, bonus, used_up = SubscriptionManager.get_available_requests(user, active=True)
                 lines.append(T.PROFILE_UPLOAD_REQUESTS.format(used_up, used_up + rem))
             else:
                 lines.append(T.PROFILE_UPLOAD_NA)
-            total_ask, used_ask = SubscriptionManager.get_ask_pulse_requests(user)
+            total_ask, used_ask = SubscriptionManager.get_ask_pulse_requests(user, active=True)
             if total_ask is not None:
                 lines.append(T.PROFILE_ASK_PULSE_REQUESTS.format(used_ask, total_ask))
             else:
@@ -553,13 +897,13 @@ class BotHandlers:
         else:
             lines = [T.PROFILE_TITLE, "", f"Подписка: не активна.", "Оформите подписку в разделе «Подписка»."]
         text = "\n".join(lines)
-        await self._reply(update, text, [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+        await self._reply(update, text, _KB_BACK_MENU)
 
     async def _subscription_status(self, update: Update):
-        user = self._user(update.effective_user.id)
+        user = await self._run_db(self._user, update.effective_user.id)
         if user and SubscriptionManager.is_subscription_active(user):
-            exp = user.subscription_expire_at.strftime("%Y-%m-%d") if user.subscription_expire_at else "—"
-            av, tot, bon, _ = SubscriptionManager.get_available_requests(user)
+            exp = user.subscription_expire_at.isoformat()[:10] if user.subscription_expire_at else "—"
+            av, tot, bon, _ = SubscriptionManager.get_available_requests(user, active=True)
             text = (
                 f"{T.SUB_STATUS_TITLE}\n\n"
                 f"{T.SUB_ACTIVE_UNTIL} {exp}\n"
@@ -571,7 +915,7 @@ class BotHandlers:
                 [InlineKeyboardButton(T.BACK, callback_data="back_menu")],
             ]
         else:
-            text = f"{T.SUB_STATUS_TITLE}\n\n{T.SUB_NO_ACTIVE}\n\n{T.SUB_WHAT_INCLUDED}"
+            text = _TXT_SUB_INACTIVE
             kb = [
                 [InlineKeyboardButton(T.SUB_GET_BTN, callback_data="subscription_plans")],
                 [InlineKeyboardButton(T.BACK, callback_data="back_menu")],
@@ -579,32 +923,10 @@ class BotHandlers:
         await self._reply(update, text, kb)
 
     async def _subscription_plans(self, update: Update):
-        text = (
-            f"{T.SUB_PLANS_TITLE}\n\n"
-            "📌 Базовая — только «Спросить Pulse», без загрузки анализов и уведомлений.\n"
-            "⭐ Премиум — загрузка анализов, уведомления, «Спросить Pulse» без лимита.\n"
-        )
-        kb = [
-            [InlineKeyboardButton("📌 Базовая 1 мес — 199 ₽", callback_data="plan_1month_basic")],
-            [InlineKeyboardButton("📌 Базовая 3 мес — 499 ₽", callback_data="plan_3months_basic")],
-            [InlineKeyboardButton("📌 Базовая 6 мес — 899 ₽", callback_data="plan_6months_basic")],
-            [InlineKeyboardButton("📌 Базовая 12 мес — 1499 ₽", callback_data="plan_12months_basic")],
-            [InlineKeyboardButton("⭐ Премиум 1 мес — 299 ₽", callback_data="plan_1month_premium")],
-            [InlineKeyboardButton("⭐ Премиум 3 мес — 799 ₽", callback_data="plan_3months_premium")],
-            [InlineKeyboardButton("⭐ Премиум 6 мес — 1399 ₽", callback_data="plan_6months_premium")],
-            [InlineKeyboardButton("⭐ Премиум 12 мес — 2499 ₽", callback_data="plan_12months_premium")],
-            [InlineKeyboardButton(T.BACK, callback_data="subscription")],
-        ]
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await self._reply(update, _TXT_PLANS, _PLANS_KB)
 
     async def _loyalty(self, update: Update):
-        text = f"{T.LOYALTY_TITLE}\n\n{T.LOYALTY_RULES}"
-        kb = [
-            [InlineKeyboardButton(T.LOYALTY_GET_LINK_BTN, callback_data="get_referral_link")],
-            [InlineKeyboardButton(T.LOYALTY_STATS_BTN, callback_data="referral_stats")],
-            [InlineKeyboardButton(T.BACK, callback_data="back_menu")],
-        ]
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await self._reply(update, _TXT_LOYALTY, _LOYALTY_KB)
 
     async def _referral_link(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = await self._ensure_user(update)
@@ -612,10 +934,13 @@ class BotHandlers:
             return
         if not user.referral_code:
             user.generate_referral_code()
-            self.db.commit()
-        bot = await context.bot.get_me()
-        link = f"https://t.me/{bot.username}?start={user.referral_code}"
-        await self._reply(update, f"{T.REFERRAL_LINK_TITLE}\n\n{link}", [[InlineKeyboardButton(T.BACK, callback_data="loyalty")]])
+            await self._run_db(self.db.commit)
+        me = context.application.bot_data.get("me")
+        if me is None:
+            # post_init мог упасть до кэширования — дозаполняем один раз
+            me = context.application.bot_data["me"] = await context.bot.get_me()
+        link = f"https://t.me/{me.username}?start={user.referral_code}"
+        await self._reply(update, f"{T.REFERRAL_LINK_TITLE}\n\n{link}", _KB_BACK_LOYALTY)
 
     async def _referral_stats(self, update: Update):
         user = await self._ensure_user(update)
@@ -628,27 +953,25 @@ class BotHandlers:
             f"{T.REFERRAL_USED} {used}\n"
             f"{T.REFERRAL_REMAINING} {remaining}"
         )
-        await self._reply(update, text, [[InlineKeyboardButton(T.BACK, callback_data="loyalty")]])
+        await self._reply(update, text, _KB_BACK_LOYALTY)
 
     async def _how_to_use(self, update: Update):
-        text = f"{T.HOW_TO_USE_TITLE}\n\n{T.HOW_TO_USE_BODY}"
-        await self._reply(update, text, [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+        await self._reply(update, _TXT_HOW_TO_USE, _KB_BACK_MENU)
 
     async def _help(self, update: Update):
-        text = f"{T.HELP_TITLE}\n\n{T.HELP_BODY}"
-        await self._reply(update, text, [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+        await self._reply(update, _TXT_HELP, _KB_BACK_MENU)
 
     async def _notifications_menu(self, update: Update):
         user = await self._ensure_user(update)
         if not user:
             return
         if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB, [[InlineKeyboardButton("💳 Подписка", callback_data="subscription")]])
+            await self._reply(update, MSG_NEED_SUB, _KB_SUBSCRIPTION)
             return
-        if (getattr(user, "subscription_plan", None) or "basic") != "premium":
-            await self._reply(update, "Уведомления доступны только по подписке Премиум.", [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+        if (user.subscription_plan or "basic") != "premium":
+            await self._reply(update, "Уведомления доступны только по подписке Премиум.", _KB_BACK_MENU)
             return
-        text = f"{T.NOTIFICATIONS_TITLE}\n\n{T.NOTIFICATIONS_DESC}"
+        text = _TXT_NOTIFICATIONS
         kb = [
             [InlineKeyboardButton(T.NOTIFICATION_CREATE_BTN, callback_data="notification_create")],
             [InlineKeyboardButton(T.NOTIFICATION_MY_BTN, callback_data="notifications_list")],
@@ -658,18 +981,16 @@ class BotHandlers:
 
     async def _notification_create_start(self, update: Update):
         user = await self._ensure_user(update)
-        if not user or not SubscriptionManager.is_subscription_active(user) or (getattr(user, "subscription_plan", None) or "basic") != "premium":
-            await self._reply(update, MSG_NEED_SUB, [[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+        if not user or not SubscriptionManager.is_subscription_active(user) or (user.subscription_plan or "basic") != "premium":
+            await self._reply(update, MSG_NEED_SUB, _KB_BACK_NOTIFICATIONS)
             return
-        FSMStorage.set_state(update.effective_user.id, States.NOTIFICATION_DATE)
-        FSMStorage.set_data(update.effective_user.id, {})
-        await self._reply(update, T.NOTIFICATION_DATE_PROMPT, [[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+        FSMStorage.set_snapshot(update.effective_user.id, States.NOTIFICATION_DATE, {})
+        await self._reply(update, T.NOTIFICATION_DATE_PROMPT, _KB_BACK_NOTIFICATIONS)
 
     def _parse_notification_date(self, s: str):
         """Принимает дату в любом формате: 19.02.2026, 19022026, 19 02 2026, 19-02-2026, 190226."""
-        import re
-        s = re.sub(r"\s+", " ", re.sub(r"[,.\-/]", " ", s.strip()))
-        digits = [int(x) for x in re.findall(r"\d+", s)]
+        s = _WS_RE.sub(" ", _NOTIF_DATE_SEP_RE.sub(" ", s.strip()))
+        digits = [int(x) for x in _DIGITS_RE.findall(s)]
         if len(digits) >= 3:
             d, m, y = digits[0], digits[1], digits[2]
             if y < 100:
@@ -700,16 +1021,12 @@ class BotHandlers:
 
     def _parse_notification_time(self, s: str):
         """Принимает время в любом формате: 14:30, 14 30, 14.30, в 5, в 17 40, давай в 5."""
-        import re
-        digits = [int(x) for x in re.findall(r"\d+", s)]
-        if len(digits) >= 2:
-            h, m = digits[0], digits[1]
+        h, m, count = _scan_two_ints(s)
+        if count >= 2:
             if 0 <= h <= 23 and 0 <= m <= 59:
                 return (h, m)
-        if len(digits) == 1:
-            h = digits[0]
-            if 0 <= h <= 23:
-                return (h, 0)
+        elif count == 1 and 0 <= h <= 23:
+            return (h, 0)
         return None
 
     async def _notification_confirm(self, update: Update):
@@ -725,65 +1042,75 @@ class BotHandlers:
         text = fsm.get("notification_text")
         if not date_str or not time_list or not text or len(time_list) < 2:
             FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
-            await self._reply(update, MSG_ERR, [[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+            await self._reply(update, MSG_ERR, _KB_BACK_NOTIFICATIONS)
             return
         try:
-            from datetime import timezone
             y, m, d = map(int, date_str.split("-"))
             h, minu = int(time_list[0]), int(time_list[1])
-            moscow = ZoneInfo("Europe/Moscow")
-            dt_moscow = datetime(y, m, d, h, minu, tzinfo=moscow)
+            dt_moscow = datetime(y, m, d, h, minu, tzinfo=MOSCOW_TZ)
             dt_utc = dt_moscow.astimezone(timezone.utc).replace(tzinfo=None)  # naive UTC для хранения
         except Exception:
             FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
-            await self._reply(update, MSG_ERR, [[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+            await self._reply(update, MSG_ERR, _KB_BACK_NOTIFICATIONS)
             return
-        self.db.add(UserNotification(user_id=user.id, scheduled_at=dt_utc, text=text))
-        self.db.commit()
-        FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
-        FSMStorage.set_data(uid, {})
-        await self._reply(update, T.NOTIFICATION_SAVED, [[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+        def _save():
+            self.db.add(UserNotification(user_id=user.id, scheduled_at=dt_utc, text=text))
+            self.db.commit()
+
+        await self._run_db(_save)
+        FSMStorage.set_snapshot(uid, States.TERMS_ACCEPTED, {})
+        await self._reply(update, T.NOTIFICATION_SAVED, _KB_BACK_NOTIFICATIONS)
 
     async def _notification_cancel(self, update: Update):
         uid = update.effective_user.id
-        FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
-        FSMStorage.set_data(uid, {})
+        FSMStorage.set_snapshot(uid, States.TERMS_ACCEPTED, {})
         await self._notifications_menu(update)
 
     async def _notification_delete(self, update: Update, notification_id: int):
         user = await self._ensure_user(update)
         if not user:
             return
-        n = self.db.query(UserNotification).filter(
-            UserNotification.id == notification_id,
-            UserNotification.user_id == user.id,
-            UserNotification.sent == False,
-        ).first()
-        if n:
-            self.db.delete(n)
+        def _delete():
+            # Один DELETE с теми же фильтрами вместо SELECT + delete():
+            # вдвое меньше round-trip на нажатие корзинки.
+            self.db.query(UserNotification).filter(
+                UserNotification.id == notification_id,
+                UserNotification.user_id == user.id,
+                UserNotification.sent == False,
+            ).delete(synchronize_session=False)
             self.db.commit()
+
+        await self._run_db(_delete)
         await self._notifications_list(update)
 
     async def _notifications_list(self, update: Update):
         user = await self._ensure_user(update)
         if not user:
             return
-        rows = self.db.query(UserNotification).filter(
+        # LIMIT на стороне БД: хвост за пределами экрана даже не едет по сети
+        rows = await self._run_db(lambda: self.db.query(UserNotification).filter(
             UserNotification.user_id == user.id,
             UserNotification.sent == False,
-        ).order_by(UserNotification.scheduled_at.asc()).all()
+        ).order_by(UserNotification.scheduled_at.asc()).limit(20).all())
         if not rows:
-            await self._reply(update, T.NOTIFICATION_LIST_EMPTY, [[InlineKeyboardButton(T.BACK, callback_data="notifications")]])
+            await self._reply(update, T.NOTIFICATION_LIST_EMPTY, _KB_BACK_NOTIFICATIONS)
             return
-        from datetime import timezone
-        moscow = ZoneInfo("Europe/Moscow")
         lines = [T.NOTIFICATION_LIST_HEADER]
         kb = []
-        for n in rows[:20]:
-            dt_utc = n.scheduled_at if n.scheduled_at.tzinfo else n.scheduled_at.replace(tzinfo=timezone.utc)
-            dt_msk = dt_utc.astimezone(moscow)
-            lines.append(f"\n• {dt_msk.strftime('%d.%m.%Y %H:%M')} (МСК)\n  {n.text[:60]}{'…' if len(n.text) > 60 else ''}")
-            kb.append([InlineKeyboardButton(f"🗑 {dt_msk.strftime('%d.%m %H:%M')}", callback_data=f"notification_del_{n.id}")])
+        # Москва не переводит часы — смещение одно на весь список; сложение
+        # с timedelta дешевле astimezone с разбором правил на каждую строку.
+        msk_offset = MOSCOW_TZ.utcoffset(datetime.now(timezone.utc))
+        for n in rows:
+            if n.scheduled_at.tzinfo is None:
+                dt_msk = n.scheduled_at + msk_offset
+            else:
+                dt_msk = n.scheduled_at.astimezone(MOSCOW_TZ)
+            # f-string c целыми полями вместо двух strftime на строку —
+            # без разбора format-строки и таблиц локали.
+            dm = f"{dt_msk.day:02d}.{dt_msk.month:02d}"
+            hm = f"{dt_msk.hour:02d}:{dt_msk.minute:02d}"
+            lines.append(f"\n• {dm}.{dt_msk.year} {hm} (МСК)\n  {n.text[:60]}{'…' if len(n.text) > 60 else ''}")
+            kb.append([InlineKeyboardButton(f"🗑 {dm} {hm}", callback_data=f"notification_del_{n.id}")])
         kb.append([InlineKeyboardButton(T.BACK, callback_data="notifications")])
         await self._reply(update, "\n".join(lines), kb)
 
@@ -791,70 +1118,81 @@ class BotHandlers:
         user = await self._ensure_user(update)
         if not user:
             return
-        if not SubscriptionManager.can_ask_pulse(self.db, user.id):
-            await self._reply(update, MSG_NEED_SUB if not SubscriptionManager.is_subscription_active(user) else "Лимит запросов «Спросить Pulse» исчерпан. Продлите подписку или дождитесь обновления лимита.", [[InlineKeyboardButton("💳 Подписка", callback_data="subscription")]])
+        if not await self._run_db(SubscriptionManager.can_ask_pulse, self.db, user.id, user):
+            await self._reply(update, MSG_NEED_SUB if not SubscriptionManager.is_subscription_active(user) else "Лимит запросов «Спросить Pulse» исчерпан. Продлите подписку или дождитесь обновления лимита.", _KB_SUBSCRIPTION)
             return
         FSMStorage.set_state(update.effective_user.id, States.ASK_PULSE_WAITING)
-        text = f"{T.ASK_PULSE_PROMPT}\n\n{T.ASK_PULSE_HINT}"
-        await self._reply(update, text, [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+        await self._reply(update, _TXT_ASK_PULSE, _KB_BACK_MENU)
 
     async def _ask_pulse_handle(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
-        """Прогресс-бар (галочки) и поиск в FAQ по ключевым словам."""
+        """Поиск в FAQ по ключевым словам; прогресс-бар крутится параллельно."""
         uid = update.effective_user.id
         chat_id = update.effective_chat.id
         steps = 5
         msg = await update.message.reply_text(f"{T.ASK_PULSE_SEARCHING} {'⬜' * steps}")
-        for i in range(1, steps + 1):
-            await asyncio.sleep(0.35)
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=msg.message_id,
-                    text=f"{T.ASK_PULSE_SEARCHING} {'✅' * i}{'⬜' * (steps - i)}",
-                )
-            except Exception:
-                pass
         if not search_faq:
             await context.bot.edit_message_text(chat_id=chat_id, message_id=msg.message_id, text=T.SERVICE_UNAVAILABLE)
             FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
             return
-        results = search_faq(query, top_k=1)
-        back_kb = InlineKeyboardMarkup([[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+
+        async def _animate():
+            # Галочки раньше отрисовывались ДО поиска и добавляли ~1.75с
+            # обязательной задержки каждому запросу. Теперь анимация — фон:
+            # быстрый поиск отменяет её сразу, медленный — прикрыт ею.
+            for i in range(1, steps + 1):
+                await asyncio.sleep(0.35)
+                try:
+                    await context.bot.edit_message_text(
+                        chat_id=chat_id,
+                        message_id=msg.message_id,
+                        text=f"{T.ASK_PULSE_SEARCHING} {'✅' * i}{'⬜' * (steps - i)}",
+                    )
+                except Exception:
+                    pass
+
+        progress = asyncio.create_task(_animate())
+        try:
+            results = await asyncio.to_thread(search_faq, query, top_k=1)
+        finally:
+            # Дожидаемся отмены, чтобы финальный edit не перегнал кадр анимации
+            progress.cancel()
+            try:
+                await progress
+            except asyncio.CancelledError:
+                pass
         if not results:
             await context.bot.edit_message_text(
-                chat_id=chat_id, message_id=msg.message_id, text=T.ASK_PULSE_NOT_FOUND, reply_markup=back_kb
+                chat_id=chat_id, message_id=msg.message_id, text=T.ASK_PULSE_NOT_FOUND, reply_markup=_KB_BACK_MENU
             )
         else:
             _, answer, _ = results[0]
             await context.bot.edit_message_text(
-                chat_id=chat_id, message_id=msg.message_id, text=f"Ответ:\n\n{answer}", reply_markup=back_kb
+                chat_id=chat_id, message_id=msg.message_id, text=f"Ответ:\n\n{answer}", reply_markup=_KB_BACK_MENU
             )
-            user = self._user(uid)
+            user = await self._run_db(self._user, uid)
             if user:
-                SubscriptionManager.use_ask_pulse_request(self.db, user.id)
+                await self._run_db(SubscriptionManager.use_ask_pulse_request, self.db, user.id)
         FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
 
     async def _upload_request(self, update: Update):
         user = await self._ensure_user(update)
         if not user:
             return
-        if not SubscriptionManager.can_perform_analysis(self.db, user.id):
-            await self._reply(update, MSG_NEED_SUB, [[InlineKeyboardButton("💳 Подписка", callback_data="subscription")]])
+        if not SubscriptionManager.can_perform_analysis(self.db, user.id, user):
+            await self._reply(update, MSG_NEED_SUB, _KB_SUBSCRIPTION)
             return
-        await update.callback_query.edit_message_text(
-            f"{T.UPLOAD_TITLE}\n\n{T.UPLOAD_DISCLAIMER}\n\n{T.UPLOAD_PROMPT}"
-        )
+        await self._reply(update, _TXT_UPLOAD)
         FSMStorage.set_state(update.effective_user.id, States.PROCESSING_FILE)
 
     async def handle_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = update.effective_user.id
         if FSMStorage.get_state(uid) != States.PROCESSING_FILE:
             return
-        user = self._user(uid)
+        user = await self._run_db(self._user, uid)
         if not user:
             await update.message.reply_text(MSG_NEED_START)
             return
-        if not SubscriptionManager.can_perform_analysis(self.db, user.id):
+        if not await self._run_db(SubscriptionManager.can_perform_analysis, self.db, user.id, user):
             await update.message.reply_text(MSG_NEED_SUB)
             await self._subscription_status(update)
             FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
@@ -870,28 +1208,29 @@ class BotHandlers:
         else:
             await update.message.reply_text(T.UPLOAD_WRONG_FILE)
             return
-        buf = bytes(await file.download_as_bytearray())
-        await update.message.reply_text(T.UPLOAD_PROCESSING)
+        # Стримим в BytesIO: без промежуточного bytearray и его копии в bytes
+        buf = io.BytesIO()
+        await file.download_to_memory(buf)
+        buf.seek(0)
         try:
             if not self.file_processor or not self.llm_service or not getattr(self.llm_service, "enabled", True):
                 await update.message.reply_text(T.SERVICE_UNAVAILABLE)
                 FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
                 return
-            raw = self.file_processor.process_file(buf, mime)
-            data = self.llm_service.extract_structured_data(raw)
-            user = self._user(uid)
-            session = AnalysisSession(user_id=user.id)
-            self.db.add(session)
-            self.db.commit()
-            self.db.refresh(session)
-            self.db.add(StructuredResult(session_id=session.id, structured_json=data))
-            self.db.commit()
-            fsm = FSMStorage.get_data(uid)
-            fsm["session_id"] = session.id
-            fsm["structured_data"] = data
-            FSMStorage.set_data(uid, fsm)
-            await update.message.reply_text(f"{T.CONTEXT_TITLE}\n\n{T.CONTEXT_AGE}")
+            # Извлечение стартует фоном, первый вопрос анкеты уходит сразу:
+            # пользователь печатает возраст, пока крутятся OCR и LLM.
+            # Результат дождёмся после последнего ответа анкеты.
+            old = _PENDING_EXTRACTIONS.pop(uid, None)
+            if old:
+                old.cancel()
+            task = asyncio.create_task(_extract_in_background(buf, mime, uid))
+            # Если анкету бросят на полпути, результат никто не прочитает —
+            # забираем исключение, чтобы не сыпались «never retrieved».
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            _PENDING_EXTRACTIONS[uid] = task
+            ActivityTracker.mark_active(user.id)
             FSMStorage.set_state(uid, States.COLLECTING_AGE)
+            await update.message.reply_text(_TXT_CONTEXT_AGE)
         except Exception as e:
             logger.error(f"File: {e}")
             await update.message.reply_text(MSG_ERR)
@@ -900,14 +1239,13 @@ class BotHandlers:
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = update.effective_user.id
         text = (update.message.text or "").strip()
-        state = FSMStorage.get_state(uid)
-        fsm = FSMStorage.get_data(uid)
+        state, fsm = FSMStorage.get_snapshot(uid)
 
         if self._is_admin(uid) and state == States.ADMIN_WAIT_ID:
             FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
             try:
                 tid = int(text)
-                user = self.db.query(User).filter(User.telegram_id == tid).first()
+                user = await self._run_db(self._user, tid)
                 if user:
                     await self._admin_user_card(update, user)
                 else:
@@ -921,7 +1259,8 @@ class BotHandlers:
             if not name:
                 await update.message.reply_text(T.ADMIN_ENTER_USERNAME)
                 return
-            user = self.db.query(User).filter(User.username.ilike(name)).first()
+            # Сравнение по lower() попадает в функциональный индекс; ilike шёл seq scan'ом
+            user = await self._run_db(lambda: self.db.query(User).filter(func.lower(User.username) == name).first())
             if user:
                 await self._admin_user_card(update, user)
             else:
@@ -945,28 +1284,23 @@ class BotHandlers:
                 await update.message.reply_text(T.NOTIFICATION_DATE_PAST)
                 return
             date_str = date_obj.strftime("%Y-%m-%d")
-            fsm["notification_date"] = date_str
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.NOTIFICATION_TIME)
-            await update.message.reply_text(T.NOTIFICATION_TIME_PROMPT, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(T.BACK, callback_data="notifications")]]))
+            FSMStorage.patch(uid, {"notification_date": date_str}, state=States.NOTIFICATION_TIME)
+            await update.message.reply_text(T.NOTIFICATION_TIME_PROMPT, reply_markup=_KB_BACK_NOTIFICATIONS)
 
         elif state == States.NOTIFICATION_TIME:
             time_tup = self._parse_notification_time(text)
             if not time_tup:
                 await update.message.reply_text(T.NOTIFICATION_INVALID_TIME)
                 return
-            fsm["notification_time"] = list(time_tup)
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.NOTIFICATION_TEXT)
-            await update.message.reply_text(T.NOTIFICATION_TEXT_PROMPT, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(T.BACK, callback_data="notifications")]]))
+            FSMStorage.patch(uid, {"notification_time": list(time_tup)}, state=States.NOTIFICATION_TEXT)
+            await update.message.reply_text(T.NOTIFICATION_TEXT_PROMPT, reply_markup=_KB_BACK_NOTIFICATIONS)
 
         elif state == States.NOTIFICATION_TEXT:
             if not text or not text.strip():
                 await update.message.reply_text(T.NOTIFICATION_EMPTY_TEXT)
                 return
             fsm["notification_text"] = text.strip()[:2000]
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.NOTIFICATION_CONFIRM)
+            FSMStorage.patch(uid, {"notification_text": fsm["notification_text"]}, state=States.NOTIFICATION_CONFIRM)
             date_str = fsm.get("notification_date", "")
             time_list = fsm.get("notification_time", [0, 0])
             try:
@@ -987,76 +1321,89 @@ class BotHandlers:
             await update.message.reply_text("Нажмите «Подтвердить» или «Отмена» под сообщением выше.")
 
         elif state == States.COLLECTING_AGE:
-            fsm["age"] = text
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.COLLECTING_SEX)
+            FSMStorage.patch(uid, {"age": text}, state=States.COLLECTING_SEX)
             await update.message.reply_text(T.CONTEXT_SEX)
         elif state == States.COLLECTING_SEX:
-            fsm["sex"] = text
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.COLLECTING_SYMPTOMS)
+            # Нормализованная форма сохраняется сразу — следующий шаг делает
+            # один hash-lookup вместо приведения регистра и скана кортежа.
+            FSMStorage.patch(uid, {"sex": text, "sex_norm": text.strip().casefold()}, state=States.COLLECTING_SYMPTOMS)
             await update.message.reply_text(T.CONTEXT_SYMPTOMS)
         elif state == States.COLLECTING_SYMPTOMS:
-            fsm["symptoms"] = text
-            FSMStorage.set_data(uid, fsm)
-            if (fsm.get("sex") or "").lower() in ("female", "f", "женский"):
-                FSMStorage.set_state(uid, States.COLLECTING_PREGNANCY)
+            sex_norm = fsm.get("sex_norm") or (fsm.get("sex") or "").casefold()
+            if sex_norm in _FEMALE_VALUES:
+                FSMStorage.patch(uid, {"symptoms": text}, state=States.COLLECTING_PREGNANCY)
                 await update.message.reply_text(T.CONTEXT_PREGNANCY)
             else:
-                fsm["pregnancy"] = "N/A"
-                FSMStorage.set_data(uid, fsm)
-                FSMStorage.set_state(uid, States.COLLECTING_CHRONIC)
+                FSMStorage.patch(uid, {"symptoms": text, "pregnancy": "N/A"}, state=States.COLLECTING_CHRONIC)
                 await update.message.reply_text(T.CONTEXT_CHRONIC)
         elif state == States.COLLECTING_PREGNANCY:
-            fsm["pregnancy"] = text
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.COLLECTING_CHRONIC)
+            FSMStorage.patch(uid, {"pregnancy": text}, state=States.COLLECTING_CHRONIC)
             await update.message.reply_text(T.CONTEXT_CHRONIC)
         elif state == States.COLLECTING_CHRONIC:
-            fsm["chronic_conditions"] = text
-            FSMStorage.set_data(uid, fsm)
-            FSMStorage.set_state(uid, States.COLLECTING_MEDICATIONS)
+            FSMStorage.patch(uid, {"chronic_conditions": text}, state=States.COLLECTING_MEDICATIONS)
             await update.message.reply_text(T.CONTEXT_MEDS)
         elif state == States.COLLECTING_MEDICATIONS:
             fsm["medications"] = text
-            FSMStorage.set_data(uid, fsm)
+            FSMStorage.patch(uid, {"medications": text})
             await update.message.reply_text(T.REPORT_GENERATING)
-            user = self._user(uid)
-            if not user or not SubscriptionManager.can_perform_analysis(self.db, user.id):
+            user = await self._run_db(self._user, uid)
+            if not user or not await self._run_db(SubscriptionManager.can_perform_analysis, self.db, user.id, user):
                 await update.message.reply_text(MSG_NEED_SUB)
                 await self._subscription_status(update)
                 FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
                 return
-            sid = fsm["session_id"]
+            # Извлечение шло параллельно с анкетой — здесь обычно
+            # достаточно забрать готовый session_id из задачи.
+            sid = fsm.get("session_id")
+            task = _PENDING_EXTRACTIONS.pop(uid, None)
+            if task is not None:
+                try:
+                    sid = await task
+                except Exception as e:
+                    logger.error(f"Extract: {e}")
+                    await update.message.reply_text(MSG_ERR)
+                    FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
+                    return
+                FSMStorage.patch(uid, {"session_id": sid})
+            if not sid:
+                await update.message.reply_text(MSG_ERR)
+                FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
+                return
             ctx = {k: fsm.get(k) for k in ("age", "sex", "symptoms", "pregnancy", "chronic_conditions", "medications")}
             try:
                 if not self.llm_service or not getattr(self.llm_service, "enabled", True):
                     await update.message.reply_text(T.SERVICE_UNAVAILABLE)
                     FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
                     return
-                report = self.llm_service.generate_clinical_report(fsm["structured_data"], ctx)
-                res = self.db.query(StructuredResult).filter(StructuredResult.session_id == sid).first()
-                if res:
-                    res.clinical_context = ctx
-                    res.report = report
-                    self.db.commit()
-                SubscriptionManager.use_request(self.db, user.id)
-                from cleanup import cleanup_user_analyses
-                cleanup_user_analyses(user.id, keep_count=3)
-                await update.message.reply_text(f"{T.REPORT_HEADER}\n\n{report}")
-                kb = [
-                    [
-                        InlineKeyboardButton("📊 Сравнить", callback_data=f"compare_from_{sid}"),
-                        InlineKeyboardButton("❓ Уточнить", callback_data=f"follow_up_{sid}"),
-                    ],
-                    [InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")],
-                    [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")],
-                ]
-                await update.message.reply_text(T.AFTER_REPORT_CHOOSE, reply_markup=InlineKeyboardMarkup(kb))
-                fsm["current_session_id"] = sid
-                fsm["follow_up_count"] = 0
-                FSMStorage.set_data(uid, fsm)
-                FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
+                res = await self._run_db(lambda: self.db.query(StructuredResult).filter(StructuredResult.session_id == sid).first())
+                if not res:
+                    await update.message.reply_text(MSG_ERR)
+                    FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
+                    return
+                async with _LLM_SEMAPHORE:
+                    report = await asyncio.to_thread(self.llm_service.generate_clinical_report, res.structured_json, ctx)
+                res.clinical_context = ctx
+                res.report = report
+                res.summary = (report[:500] + "…") if len(report) > 500 else report
+                # Списание запроса в той же транзакции, что и отчёт:
+                # use_request сделал бы повторный SELECT и второй commit,
+                # а лимит уже проверен can_perform_analysis выше.
+                user.used_requests = (user.used_requests or 0) + 1
+                await self._run_db(self.db.commit)
+                # Чистка старых анализов — вне горячего пути: у неё своя
+                # сессия, ответа пользователю она не задерживает.
+                asyncio.create_task(asyncio.to_thread(cleanup_user_analyses, user.id, 3))
+                markup = _session_actions_kb(sid)
+                # Отчёт и кнопки в одном сообщении — один вызов API вместо
+                # двух; на отдельное сообщение разваливаемся только когда
+                # текст не влезает в лимит Telegram.
+                combined = f"{T.REPORT_HEADER}\n\n{report}\n\n{T.AFTER_REPORT_CHOOSE}"
+                if len(combined) <= 4096:
+                    await update.message.reply_text(combined, reply_markup=markup)
+                else:
+                    await update.message.reply_text(f"{T.REPORT_HEADER}\n\n{report}")
+                    await update.message.reply_text(T.AFTER_REPORT_CHOOSE, reply_markup=markup)
+                FSMStorage.patch(uid, {"current_session_id": sid, "follow_up_count": 0}, state=States.TERMS_ACCEPTED)
             except Exception as e:
                 logger.error(f"Report: {e}")
                 await update.message.reply_text(MSG_ERR)
@@ -1072,7 +1419,7 @@ class BotHandlers:
             if not sid:
                 await update.message.reply_text(T.FOLLOW_UP_SESSION_LOST)
                 return
-            res = self.db.query(StructuredResult).filter(StructuredResult.session_id == sid).first()
+            res = await self._run_db(lambda: self.db.query(StructuredResult).filter(StructuredResult.session_id == sid).first())
             if not res:
                 await update.message.reply_text(T.ANALYSIS_NOT_FOUND)
                 return
@@ -1080,12 +1427,18 @@ class BotHandlers:
                 if not self.llm_service or not getattr(self.llm_service, "enabled", True):
                     await update.message.reply_text(T.SERVICE_UNAVAILABLE)
                     return
-                ans = self.llm_service.answer_follow_up_question(res.structured_json, res.clinical_context or {}, res.report or "", text)
-                self.db.add(FollowUpQuestion(session_id=sid, question=text, answer=ans))
-                self.db.commit()
+                async with _LLM_SEMAPHORE:
+                    ans = await asyncio.to_thread(
+                        self.llm_service.answer_follow_up_question,
+                        res.structured_json, res.clinical_context or {}, res.report or "", text,
+                    )
+                def _save():
+                    self.db.add(FollowUpQuestion(session_id=sid, question=text, answer=ans))
+                    self.db.commit()
+
+                await self._run_db(_save)
                 await update.message.reply_text(ans)
-                fsm["follow_up_count"] = n + 1
-                FSMStorage.set_data(uid, fsm)
+                FSMStorage.patch(uid, {"follow_up_count": n + 1})
                 if n + 1 >= 2:
                     await self._main_menu(update)
                     FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
@@ -1103,27 +1456,27 @@ class BotHandlers:
             await self._main_menu(update)
             FSMStorage.set_state(uid, States.TERMS_ACCEPTED)
 
-    async def _follow_up_ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def _follow_up_ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str | None = None):
         await update.callback_query.answer()
-        user = await self._ensure_user(update)
-        if not user or not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
+        user = await self._ensure_active_user(update)
+        if not user:
             return
         uid = update.effective_user.id
-        data = update.callback_query.data
-        sid = int(data.replace("follow_up_", "")) if data.startswith("follow_up_") else (FSMStorage.get_data(uid).get("current_session_id") or FSMStorage.get_data(uid).get("session_id"))
+        # Данные FSM читаются один раз: три отдельных get_data — три
+        # round-trip к Redis на одно нажатие.
+        fsm = FSMStorage.get_data(uid)
+        # payload уже отрезан диспетчером по длине префикса — повторный
+        # разбор callback_data через replace не нужен.
+        sid = int(payload) if payload else (fsm.get("current_session_id") or fsm.get("session_id"))
         if not sid:
             await self._reply(update, T.ANALYSIS_NOT_FOUND)
             return
-        n = FSMStorage.get_data(uid).get("follow_up_count", 0)
+        n = fsm.get("follow_up_count", 0)
         if n >= 2:
             await self._reply(update, T.FOLLOW_UP_LIMIT)
             await self._main_menu(update)
             return
-        fsm = FSMStorage.get_data(uid)
-        fsm["current_session_id"] = sid
-        FSMStorage.set_data(uid, fsm)
-        FSMStorage.set_state(uid, States.WAITING_FOLLOW_UP)
+        FSMStorage.patch(uid, {"current_session_id": sid}, state=States.WAITING_FOLLOW_UP)
         await self._reply(update, T.FOLLOW_UP_ASK.format(2 - n))
 
     async def _payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, plan: str):
@@ -1138,151 +1491,141 @@ class BotHandlers:
             await update.callback_query.edit_message_text(MSG_ERR)
 
     async def _recent_analyses(self, update: Update):
-        user = await self._ensure_user(update)
+        user = await self._ensure_active_user(update)
         if not user:
             return
-        if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
-            return
-        sessions = self.db.query(AnalysisSession).filter(AnalysisSession.user_id == user.id).order_by(AnalysisSession.created_at.desc()).limit(3).all()
-        if not sessions:
+        # Нужны только id и дата — лёгкие кортежи вместо гидрации полных
+        # ORM-объектов с отслеживанием в identity map.
+        # Дату форматирует Postgres (to_char) — strftime на каждую строку
+        # в Python не нужен.
+        rows = await self._run_db(lambda: self.db.query(AnalysisSession.id, func.to_char(AnalysisSession.created_at, "YYYY-MM-DD HH24:MI")).filter(AnalysisSession.user_id == user.id).order_by(AnalysisSession.created_at.desc()).limit(3).all())
+        if not rows:
             kb = [
                 [InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")],
                 [InlineKeyboardButton(T.BACK, callback_data="back_menu")],
             ]
-            await self._reply(update, f"{T.RECENT_TITLE}\n\n{T.RECENT_EMPTY}", kb)
+            await self._reply(update, _TXT_RECENT_EMPTY, kb)
             return
         lines = []
         kb = []
-        for s in sessions:
-            d = s.created_at.strftime("%Y-%m-%d %H:%M")
+        for sid, d in rows:
             lines.append(f"• {d}")
-            kb.append([InlineKeyboardButton(f"📄 {d}", callback_data=f"analysis_{s.id}")])
+            kb.append([InlineKeyboardButton(f"📄 {d}", callback_data=f"analysis_{sid}")])
         kb.append([InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")])
         kb.append([InlineKeyboardButton(T.BACK, callback_data="back_menu")])
         await self._reply(update, f"{T.RECENT_TITLE}\n\n{T.RECENT_CHOOSE}\n\n" + "\n".join(lines), kb)
 
     async def _analysis_detail(self, update: Update, session_id: int):
-        user = await self._ensure_user(update)
+        user = await self._ensure_active_user(update)
         if not user:
             return
-        if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
-            return
-        session = self.db.query(AnalysisSession).filter(AnalysisSession.id == session_id, AnalysisSession.user_id == user.id).first()
-        if not session:
-            await self._reply(update, T.ANALYSIS_NOT_FOUND)
-            return
-        res = self.db.query(StructuredResult).filter(StructuredResult.session_id == session_id).first()
-        if not res or not res.report:
+        # Готовая выжимка хранится в summary — полный отчёт (может быть
+        # несколько КБ) для экрана «кратко» из БД не тянем.
+        summary = await self._run_db(
+            lambda: self.db.query(StructuredResult.summary)
+            .join(AnalysisSession, AnalysisSession.id == StructuredResult.session_id)
+            .filter(StructuredResult.session_id == session_id, AnalysisSession.user_id == user.id)
+            .scalar()
+        )
+        if not summary:
             await self._reply(update, T.ANALYSIS_NOT_FOUND)
             return
-        summary = (res.report[:500] + "…") if len(res.report) > 500 else res.report
         kb = [
             [InlineKeyboardButton(T.DETAIL_FULL_REPORT_BTN, callback_data=f"full_report_{session_id}")],
-            [
-                InlineKeyboardButton("📊 Сравнить", callback_data=f"compare_from_{session_id}"),
-                InlineKeyboardButton("❓ Уточнить", callback_data=f"follow_up_{session_id}"),
-            ],
-            [InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")],
-            [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")],
+            *_session_actions_kb(session_id).inline_keyboard,
         ]
         await self._reply(update, f"{T.DETAIL_SUMMARY}\n\n{summary}", kb)
 
     async def _analysis_full_report(self, update: Update, session_id: int):
         """Show full report text (chunked if > 4096)."""
-        user = await self._ensure_user(update)
+        user = await self._ensure_active_user(update)
         if not user:
             return
-        if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
-            return
-        session = self.db.query(AnalysisSession).filter(AnalysisSession.id == session_id, AnalysisSession.user_id == user.id).first()
-        if not session:
-            await self._reply(update, T.ANALYSIS_NOT_FOUND)
-            return
-        res = self.db.query(StructuredResult).filter(StructuredResult.session_id == session_id).first()
+        session = await self._run_db(
+            lambda: self.db.query(AnalysisSession)
+            .options(joinedload(AnalysisSession.structured_result))
+            .filter(AnalysisSession.id == session_id, AnalysisSession.user_id == user.id)
+            .first()
+        )
+        res = session.structured_result if session else None
         if not res or not res.report:
             await self._reply(update, T.ANALYSIS_NOT_FOUND)
             return
         report = res.report
         chunk_size = 4090
         if len(report) <= chunk_size:
-            await self._reply(update, f"{T.REPORT_HEADER}\n\n{report}", [
-                [
-                    InlineKeyboardButton("📊 Сравнить", callback_data=f"compare_from_{session_id}"),
-                    InlineKeyboardButton("❓ Уточнить", callback_data=f"follow_up_{session_id}"),
-                ],
-                [InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")],
-                [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")],
-            ])
+            await self._reply(update, f"{T.REPORT_HEADER}\n\n{report}", _session_actions_kb(session_id))
             return
-        for i in range(0, len(report), chunk_size):
-            chunk = report[i : i + chunk_size]
+        # Первая часть рисуется редактированием сообщения с меню (мы пришли
+        # сюда по callback), кнопки цепляются к последней части — N частей
+        # уходят за N вызовов API без вводного и хвостового сообщений.
+        # textwrap режет по пробелам, а не посреди слова; переносы строк
+        # внутри частей сохраняются (replace_whitespace=False).
+        chunks = textwrap.wrap(
+            report, chunk_size,
+            replace_whitespace=False, drop_whitespace=False,
+            break_long_words=True, break_on_hyphens=False,
+        ) or [report]
+        await self._reply(update, chunks[0])
+        for chunk in chunks[1:-1]:
             await update.effective_message.reply_text(chunk)
-        kb = [
-            [
-                InlineKeyboardButton("📊 Сравнить", callback_data=f"compare_from_{session_id}"),
-                InlineKeyboardButton("❓ Уточнить", callback_data=f"follow_up_{session_id}"),
-            ],
-            [InlineKeyboardButton(T.RECENT_UPLOAD_BTN, callback_data="upload_analysis")],
-            [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")],
-        ]
-        await update.effective_message.reply_text("Выберите действие:", reply_markup=InlineKeyboardMarkup(kb))
+        await update.effective_message.reply_text(chunks[-1], reply_markup=_session_actions_kb(session_id))
 
     async def _compare_request(self, update: Update):
-        user = await self._ensure_user(update)
+        user = await self._ensure_active_user(update)
         if not user:
             return
-        if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
-            return
-        sessions = self.db.query(AnalysisSession).filter(AnalysisSession.user_id == user.id).order_by(AnalysisSession.created_at.desc()).limit(3).all()
+        sessions = await self._run_db(lambda: self.db.query(AnalysisSession.id, func.to_char(AnalysisSession.created_at, "YYYY-MM-DD").label("d")).filter(AnalysisSession.user_id == user.id).order_by(AnalysisSession.created_at.desc()).limit(3).all())
         if len(sessions) < 2:
-            await self._reply(update, T.COMPARE_NEED_TWO, [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+            await self._reply(update, T.COMPARE_NEED_TWO, _KB_BACK_MENU)
             return
-        kb = []
-        for i in range(min(2, len(sessions))):
-            for j in range(i + 1, min(3, len(sessions))):
-                a, b = sessions[i], sessions[j]
-                kb.append([InlineKeyboardButton(f"{a.created_at.strftime('%Y-%m-%d')} и {b.created_at.strftime('%Y-%m-%d')}", callback_data=f"compare_{a.id}_{b.id}")])
+        # Храним максимум 3 анализа — пары известны заранее, вложенные циклы
+        # с range/индексной арифметикой не нужны.
+        pairs = [(0, 1)] if len(sessions) == 2 else [(0, 1), (0, 2), (1, 2)]
+        kb = [
+            [InlineKeyboardButton(
+                f"{sessions[i].d} и {sessions[j].d}",
+                callback_data=f"compare_{sessions[i].id}_{sessions[j].id}",
+            )]
+            for i, j in pairs
+        ]
         kb.append([InlineKeyboardButton(T.BACK, callback_data="back_menu")])
-        await self._reply(update, f"{T.COMPARE_TITLE}\n\n{T.COMPARE_CHOOSE_PAIR}", kb)
+        await self._reply(update, _TXT_COMPARE_CHOOSE, kb)
 
     async def _compare_from(self, update: Update, session_id: int):
-        user = await self._ensure_user(update)
+        user = await self._ensure_active_user(update)
         if not user:
             return
-        if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
-            return
-        current = self.db.query(AnalysisSession).filter(AnalysisSession.id == session_id, AnalysisSession.user_id == user.id).first()
+        current = await self._run_db(lambda: self.db.query(AnalysisSession.id).filter(AnalysisSession.id == session_id, AnalysisSession.user_id == user.id).scalar())
         if not current:
             await self._reply(update, T.ANALYSIS_NOT_FOUND)
             return
-        others = self.db.query(AnalysisSession).filter(AnalysisSession.user_id == user.id, AnalysisSession.id != session_id).order_by(AnalysisSession.created_at.desc()).limit(3).all()
+        others = await self._run_db(lambda: self.db.query(AnalysisSession.id, func.to_char(AnalysisSession.created_at, "YYYY-MM-DD")).filter(AnalysisSession.user_id == user.id, AnalysisSession.id != session_id).order_by(AnalysisSession.created_at.desc()).limit(3).all())
         if not others:
             await self._reply(update, T.COMPARE_NEED_ANOTHER, [[InlineKeyboardButton(T.BACK, callback_data=f"analysis_{session_id}")]])
             return
-        kb = [[InlineKeyboardButton(s.created_at.strftime("%Y-%m-%d"), callback_data=f"compare_{session_id}_{s.id}")] for s in others]
+        kb = [[InlineKeyboardButton(d, callback_data=f"compare_{session_id}_{sid}")] for sid, d in others]
         kb.append([InlineKeyboardButton(T.BACK, callback_data=f"analysis_{session_id}")])
         await self._reply(update, T.COMPARE_CHOOSE_SECOND, kb)
 
     async def _do_compare(self, update: Update, context: ContextTypes.DEFAULT_TYPE, session_ids: list):
-        user = await self._ensure_user(update)
-        if not user or len(session_ids) < 2:
+        if len(session_ids) < 2:
             return
-        if not SubscriptionManager.is_subscription_active(user):
-            await self._reply(update, MSG_NEED_SUB)
+        user = await self._ensure_active_user(update)
+        if not user:
             return
         s1_id, s2_id = int(session_ids[0]), int(session_ids[1])
-        s1 = self.db.query(AnalysisSession).filter(AnalysisSession.id == s1_id, AnalysisSession.user_id == user.id).first()
-        s2 = self.db.query(AnalysisSession).filter(AnalysisSession.id == s2_id, AnalysisSession.user_id == user.id).first()
-        if not s1 or not s2:
-            await self._reply(update, T.COMPARE_NOT_FOUND)
-            return
-        r1 = self.db.query(StructuredResult).filter(StructuredResult.session_id == s1_id).first()
-        r2 = self.db.query(StructuredResult).filter(StructuredResult.session_id == s2_id).first()
+        # Обе сессии с результатами одним запросом: INNER JOIN сразу
+        # отбрасывает сессии без результата, без отдельных проверок.
+        rows = await self._run_db(
+            lambda: self.db.query(AnalysisSession, StructuredResult)
+            .join(StructuredResult, StructuredResult.session_id == AnalysisSession.id)
+            .filter(AnalysisSession.id.in_([s1_id, s2_id]), AnalysisSession.user_id == user.id)
+            .all()
+        )
+        by_id = {s.id: (s, r) for s, r in rows}
+        s1, r1 = by_id.get(s1_id, (None, None))
+        s2, r2 = by_id.get(s2_id, (None, None))
         if not r1 or not r2:
             await self._reply(update, T.COMPARE_NOT_FOUND)
             return
@@ -1292,11 +1635,23 @@ class BotHandlers:
                 await self._reply(update, T.SERVICE_UNAVAILABLE)
                 return
             c1 = dict(r1.clinical_context or {})
-            c1["date"] = s1.created_at.strftime("%Y-%m-%d")
+            c1["date"] = s1.created_at.isoformat()[:10]
             c2 = dict(r2.clinical_context or {})
-            c2["date"] = s2.created_at.strftime("%Y-%m-%d")
-            report = self.llm_service.compare_analyses(r1.structured_json, r2.structured_json, c1, c2)
-            await self._reply(update, report, [[InlineKeyboardButton(T.BACK, callback_data="back_menu")]])
+            c2["date"] = s2.created_at.isoformat()[:10]
+            # Пара сессий неизменна после генерации отчётов — повторное
+            # «Сравнить» по той же паре отдаётся из Redis без похода в LLM.
+            cache_key = f"llm:compare:{min(s1_id, s2_id)}:{max(s1_id, s2_id)}"
+            # Синхронный Redis тоже уводится с event loop — блокирует так же,
+            # как и SQL, просто реже заметен.
+            report = await asyncio.to_thread(LLMCache.get, cache_key)
+            if report is None:
+                async with _LLM_SEMAPHORE:
+                    report = await asyncio.to_thread(
+                        self.llm_service.compare_analyses,
+                        r1.structured_json, r2.structured_json, c1, c2,
+                    )
+                await asyncio.to_thread(LLMCache.put, cache_key, report, 86400)
+            await self._reply(update, report, _KB_BACK_MENU)
         except Exception as e:
             logger.error(f"Compare: {e}")
             await self._reply(update, MSG_ERR)
@@ -1,5 +1,5 @@
 """Database models and connection."""
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, JSON, Numeric, Text
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, JSON, Numeric, Text, Index, and_, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -21,15 +21,18 @@ try:
         db_url,
         echo=False,
         pool_pre_ping=True,  # Verify connections before using
-        pool_recycle=3600,   # Recycle connections after 1 hour
-        pool_size=5,         # Connection pool size
-        max_overflow=10,     # Max overflow connections
+        pool_recycle=1800,   # Recycle connections after 30 minutes
+        pool_size=20,        # Bot + admin dashboard polling share this pool
+        max_overflow=20,     # Max overflow connections
+        pool_use_lifo=True,  # Reuse the hottest connection (warm PG caches)
         connect_args={
             "connect_timeout": 10,
             "options": "-c statement_timeout=30000"
         }
     )
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    # expire_on_commit=False: после commit атрибуты не инвалидируются, и обращение
+    # к ним в том же обработчике не делает повторный SELECT всей строки
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 except Exception as e:
     from loguru import logger
     logger.error(f"❌ Failed to create PostgreSQL database engine: {e}")
@@ -51,11 +54,18 @@ class User(Base):
     used_requests = Column(Integer, default=0)  # Использовано загрузок анализов
     total_ask_pulse_requests = Column(Integer, nullable=True)  # Лимит «Спросить Pulse» (NULL = без лимита)
     used_ask_pulse_requests = Column(Integer, default=0)  # Использовано запросов Спросить Pulse
+    has_paid = Column(Boolean, default=False)  # Денормализация: есть хотя бы одна успешная оплата
     referrer_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Who referred this user
     referral_code = Column(String, unique=True, nullable=True, index=True)  # Unique referral code
     username = Column(String, nullable=True, index=True)  # Telegram @username for admin search
     created_at = Column(DateTime, default=datetime.utcnow)
-    
+
+    __table_args__ = (
+        # Dashboard: daily registrations series and active-subscription counts
+        Index("ix_users_created_at", "created_at"),
+        Index("ix_users_sub_active", "subscription_status", "subscription_expire_at", "subscription_plan"),
+    )
+
     # Relationships
     payments = relationship("Payment", back_populates="user", foreign_keys="Payment.user_id")
     analysis_sessions = relationship("AnalysisSession", back_populates="user")
@@ -68,6 +78,18 @@ class User(Base):
             self.referral_code = secrets.token_urlsafe(8)[:12].upper()
         return self.referral_code
 
+    @classmethod
+    def active_filter(cls, now=None):
+        """SQL predicate for an unexpired active subscription.
+
+        Shared by the dashboard queries so the (subscription_status,
+        subscription_expire_at, subscription_plan) index covers them all.
+        """
+        return and_(
+            cls.subscription_status == "active",
+            cls.subscription_expire_at > (now or datetime.utcnow()),
+        )
+
 
 class Payment(Base):
     """Payment model."""
@@ -82,7 +104,17 @@ class Payment(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
     payment_date = Column(DateTime, nullable=True)  # Actual payment date
-    
+
+    __table_args__ = (
+        # Dashboard: revenue series filters on status='completed' + completed_at range
+        Index(
+            "ix_payments_status_completed_at",
+            "status",
+            "completed_at",
+            postgresql_where=text("status = 'completed'"),
+        ),
+    )
+
     # Relationships
     user = relationship("User", back_populates="payments", foreign_keys=[user_id])
     referral = relationship("Referral", back_populates="payment", uselist=False)
@@ -94,8 +126,13 @@ class AnalysisSession(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        # «Последние 3 анализа»: ORDER BY created_at + LIMIT одним range scan
+        Index("ix_analysis_sessions_user_created", "user_id", "created_at"),
+    )
+
     # Relationships
     user = relationship("User", back_populates="analysis_sessions")
     structured_result = relationship("StructuredResult", back_populates="session", uselist=False)
@@ -111,8 +148,9 @@ class StructuredResult(Base):
     structured_json = Column(JSON, nullable=False)  # JSONB in PostgreSQL
     clinical_context = Column(JSON, nullable=True)  # Age, sex, symptoms, etc.
     report = Column(Text, nullable=True)  # Generated clinical report
+    summary = Column(String(520), nullable=True)  # Первые ~500 символов отчёта для экрана «кратко»
     created_at = Column(DateTime, default=datetime.utcnow)
-    
+
     # Relationships
     session = relationship("AnalysisSession", back_populates="structured_result")
 
@@ -142,10 +180,28 @@ class UserNotification(Base):
     sent = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # Покрывает и список уведомлений пользователя (user_id, sent,
+    # ORDER BY scheduled_at), и выборку планировщика по sent/scheduled_at.
+    __table_args__ = (
+        Index("ix_user_notif_active", "user_id", "sent", "scheduled_at"),
+    )
+
     # Relationships
     user = relationship("User", backref="notifications", foreign_keys=[user_id])
 
 
+class DashboardSummary(Base):
+    """Snapshot of slow-moving dashboard totals (refreshed by the scheduler)."""
+    __tablename__ = "dashboard_summary"
+
+    id = Column(Integer, primary_key=True, index=True)
+    asof = Column(DateTime, default=datetime.utcnow, index=True)
+    total_users = Column(Integer, nullable=False, default=0)
+    total_analyses = Column(Integer, nullable=False, default=0)
+    total_revenue = Column(Numeric(12, 2), nullable=False, default=0)
+    total_referrals = Column(Integer, nullable=False, default=0)
+
+
 class Referral(Base):
     """Referral tracking model."""
     __tablename__ = "referrals"
@@ -196,6 +252,22 @@ def _migrate_add_columns(conn):
         conn.execute(text("ALTER TABLE users ADD COLUMN total_ask_pulse_requests INTEGER"))
     if not _column_exists(conn, "users", "used_ask_pulse_requests"):
         conn.execute(text("ALTER TABLE users ADD COLUMN used_ask_pulse_requests INTEGER DEFAULT 0"))
+    if not _column_exists(conn, "structured_results", "summary"):
+        conn.execute(text("ALTER TABLE structured_results ADD COLUMN summary VARCHAR(520)"))
+        # Backfill, чтобы экран «кратко» не читал полный отчёт у старых записей
+        conn.execute(text("""
+            UPDATE structured_results
+            SET summary = CASE WHEN length(report) > 500 THEN left(report, 500) || '…' ELSE report END
+            WHERE report IS NOT NULL
+        """))
+    if not _column_exists(conn, "users", "has_paid"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN has_paid BOOLEAN DEFAULT FALSE"))
+        # Backfill from existing completed payments, then keep in sync on payment success
+        conn.execute(text("""
+            UPDATE users SET has_paid = TRUE
+            WHERE id IN (SELECT DISTINCT user_id FROM payments WHERE status = 'completed')
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_has_paid ON users(has_paid) WHERE has_paid"))
     # user_notifications table (created by create_all if new; for old DBs without Alembic)
     conn.execute(text("""
         CREATE TABLE IF NOT EXISTS user_notifications (
@@ -207,6 +279,30 @@ def _migrate_add_columns(conn):
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """))
+    # Indexes for the dashboard filter predicates (create_all only creates
+    # indexes together with new tables, so existing DBs need them here)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_created_at ON users(created_at)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_users_sub_active "
+        "ON users(subscription_status, subscription_expire_at, subscription_plan)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_analysis_sessions_created_at ON analysis_sessions(created_at)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_analysis_sessions_user_created "
+        "ON analysis_sessions(user_id, created_at)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_payments_status_completed_at "
+        "ON payments(status, completed_at) WHERE status = 'completed'"
+    ))
+    # Функциональный индекс для админ-поиска по username без учёта регистра
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username))"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_notif_active "
+        "ON user_notifications(user_id, sent, scheduled_at)"
+    ))
     # Telegram user IDs can exceed 2^31; ensure BIGINT
     conn.execute(text("ALTER TABLE users ALTER COLUMN telegram_id TYPE BIGINT"))
     conn.execute(text("""
@@ -493,6 +493,32 @@ MIN_SCORE = 2.5
 MIN_MATCH_IN_QUESTION = 1
 
 
+def _build_index():
+    """Токенизация базы один раз при импорте.
+
+    После расширения префиксами в FAQ_LIST десятки тысяч записей; прогонять
+    каждую через regex-нормализацию на каждый запрос — почти вся стоимость
+    поиска. Храним готовые наборы токенов и флаги направления, плюс
+    обратный индекс «токен вопроса -> записи»: кандидатами становятся только
+    записи, пересекающиеся с запросом хотя бы одним токеном вопроса
+    (остальные всё равно отсеялись бы по MIN_MATCH_IN_QUESTION).
+    """
+    entries = []
+    token_to_ids = {}
+    for i, item in enumerate(FAQ_LIST):
+        q_tok = frozenset(_normalize(item["q"], allow_short=True))
+        a_tok = frozenset(_normalize(item["a"], allow_short=True))
+        both = q_tok | a_tok
+        entries.append((item["q"], item["a"], q_tok, a_tok,
+                        bool(both & DIRECTION_HIGH), bool(both & DIRECTION_LOW)))
+        for t in q_tok:
+            token_to_ids.setdefault(t, []).append(i)
+    return entries, token_to_ids
+
+
+_FAQ_ENTRIES, _FAQ_TOKEN_INDEX = _build_index()
+
+
 def search_faq(query: str, top_k: int = 3) -> List[Tuple[str, str, float]]:
     """
     Улучшенный поиск: препроцессинг, синонимы, учёт направления (высокий/низкий), порог, дедупликация.
@@ -509,14 +535,14 @@ def search_faq(query: str, top_k: int = 3) -> List[Tuple[str, str, float]]:
     query_has_high = bool(q_tokens_expanded & DIRECTION_HIGH)
     query_has_low = bool(q_tokens_expanded & DIRECTION_LOW)
     query_terms_count = len(q_tokens_expanded)
+    # Кандидаты из обратного индекса; sorted сохраняет порядок базы, чтобы
+    # при равном счёте побеждала та же запись, что и при линейном проходе
+    candidate_ids = set()
+    for t in q_tokens_expanded:
+        candidate_ids.update(_FAQ_TOKEN_INDEX.get(t, ()))
     results = []
-    for item in FAQ_LIST:
-        q_text = item["q"]
-        a_text = item["a"]
-        q_tok = set(_normalize(q_text, allow_short=True))
-        a_tok = set(_normalize(a_text, allow_short=True))
-        faq_has_high = bool((q_tok | a_tok) & DIRECTION_HIGH)
-        faq_has_low = bool((q_tok | a_tok) & DIRECTION_LOW)
+    for i in sorted(candidate_ids):
+        q_text, a_text, q_tok, a_tok, faq_has_high, faq_has_low = _FAQ_ENTRIES[i]
         # Ответ должен соответствовать направлению: высокий запрос — не выдаём ответ про низкий, и наоборот
         if query_has_high and faq_has_low and not faq_has_high:
             continue
@@ -11,8 +11,8 @@ class FileProcessor:
     """Process PDF and image files to extract text."""
     
     @staticmethod
-    def extract_text_from_pdf(file_bytes: bytes) -> str:
-        """Extract text from PDF file."""
+    def extract_text_from_pdf(file_bytes) -> str:
+        """Extract text from PDF file (bytes or file-like buffer)."""
         try:
             doc = fitz.open(stream=file_bytes, filetype="pdf")
             text_parts = []
@@ -36,7 +36,7 @@ class FileProcessor:
             raise
     
     @staticmethod
-    def extract_text_from_image(file_bytes: bytes, image_format: str = "PNG") -> str:
+    def extract_text_from_image(file_bytes, image_format: str = "PNG") -> str:
         """Extract text from image using OCR."""
         try:
             return FileProcessor._ocr_image(file_bytes)
@@ -45,10 +45,10 @@ class FileProcessor:
             raise
     
     @staticmethod
-    def _ocr_image(image_bytes: bytes) -> str:
-        """Perform OCR on image bytes."""
+    def _ocr_image(image_bytes) -> str:
+        """Perform OCR on image bytes or a file-like buffer."""
         try:
-            image = Image.open(io.BytesIO(image_bytes))
+            image = Image.open(image_bytes if hasattr(image_bytes, "read") else io.BytesIO(image_bytes))
             # Configure Tesseract for Russian and English
             text = pytesseract.image_to_string(
                 image,
@@ -61,8 +61,13 @@ class FileProcessor:
             raise
     
     @staticmethod
-    def process_file(file_bytes: bytes, file_type: str) -> str:
-        """Process file and extract text."""
+    def process_file(file_bytes, file_type: str) -> str:
+        """Process file and extract text.
+
+        Accepts raw bytes or a file-like buffer (e.g. BytesIO from a streamed
+        Telegram download) — both PyMuPDF and PIL read streams directly, so
+        no extra copy of the file is materialized.
+        """
         if file_type == "pdf" or file_type == "application/pdf":
             return FileProcessor.extract_text_from_pdf(file_bytes)
         elif file_type in ["jpg", "jpeg", "png", "image/jpeg", "image/png"]:
@@ -1,11 +1,61 @@
 """LLM service for structured extraction and report generation."""
 from openai import OpenAI
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from config import settings
+from redis_client import redis_client, redis_available
 from loguru import logger
+import hashlib
 import json
 
 
+class LLMCache:
+    """Redis-кэш детерминированных ответов LLM.
+
+    Одинаковый вход (например, два пользователя загрузили один и тот же бланк)
+    не ходит в платный API повторно. Кэшируем только низкотемпературные вызовы.
+    """
+
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def get(key: str) -> Optional[str]:
+        if not redis_available or not redis_client:
+            return None
+        try:
+            raw = redis_client.get(key)
+        except Exception as e:
+            logger.warning(f"Redis LLM cache get error: {e}")
+            return None
+        if raw is None:
+            LLMCache.misses += 1
+            return None
+        LLMCache.hits += 1
+        if LLMCache.hits % 100 == 0:
+            logger.info(f"LLM cache: {LLMCache.hits} hits / {LLMCache.misses} misses")
+        return raw
+
+    @staticmethod
+    def put(key: str, value: str, ttl: int):
+        if not redis_available or not redis_client:
+            return
+        try:
+            redis_client.setex(key, ttl, value)
+        except Exception as e:
+            logger.warning(f"Redis LLM cache set error: {e}")
+
+
+def _cache_fingerprint(raw_text: str) -> str:
+    """Нормализует текст перед хэшированием для ключа кэша.
+
+    Два скана одного бланка почти никогда не совпадают байт в байт: OCR даёт
+    разные пробелы, переводы строк и регистр. Схлопываем пробельные
+    последовательности и приводим к нижнему регистру — только для ключа,
+    в LLM уходит исходный текст.
+    """
+    return " ".join(raw_text.lower().split())
+
+
 class LLMService:
     """Service for LLM interactions."""
     
@@ -30,7 +80,12 @@ class LLMService:
         """Extract structured laboratory data from raw text."""
         if not self.enabled or not self.client:
             raise ValueError("OpenAI API key not configured. Cannot extract structured data.")
-        
+
+        cache_key = "llm:extract:" + hashlib.sha256(_cache_fingerprint(raw_text).encode()).hexdigest()
+        cached = LLMCache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
         prompt = """You are a medical data extraction system. Extract laboratory test results from the provided text and return ONLY valid JSON.
 
 Extract:
@@ -74,6 +129,7 @@ Return ONLY the JSON object, no additional text."""
             )
             
             result = json.loads(response.choices[0].message.content)
+            LLMCache.put(cache_key, json.dumps(result, ensure_ascii=False), 86400)
             return result
         except Exception as e:
             logger.error(f"Error extracting structured data: {e}")
@@ -193,6 +249,32 @@ Generate a comparison report focusing on changes and trends."""
             logger.error(f"Error comparing analyses: {e}")
             raise
     
+    def _follow_up_context(
+        self,
+        structured_data: Dict[str, Any],
+        clinical_context: Dict[str, Any],
+        original_report: str
+    ) -> str:
+        """Общая для всех уточняющих вопросов часть промпта.
+
+        На один отчёт допускается до двух вопросов, и между ними меняется
+        только сам вопрос — готовый префикс (с дорогой JSON-сериализацией
+        результатов) кладётся в Redis на час и переиспользуется.
+        """
+        key = "llm:fu_ctx:" + hashlib.sha256(original_report.encode()).hexdigest()
+        ctx = LLMCache.get(key)
+        if ctx is None:
+            ctx = f"""Original Analysis Report:
+{original_report}
+
+Laboratory Results:
+{json.dumps(structured_data, indent=2, ensure_ascii=False)}
+
+Clinical Context:
+{json.dumps(clinical_context, indent=2, ensure_ascii=False)}"""
+            LLMCache.put(key, ctx, 3600)
+        return ctx
+
     def answer_follow_up_question(
         self,
         structured_data: Dict[str, Any],
@@ -215,14 +297,8 @@ CRITICAL RULES:
 6. Do not use emojis
 7. Keep answers concise and focused"""
 
-        user_prompt = f"""Original Analysis Report:
-{original_report}
-
-Laboratory Results:
-{json.dumps(structured_data, indent=2, ensure_ascii=False)}
-
-Clinical Context:
-{json.dumps(clinical_context, indent=2, ensure_ascii=False)}
+        context_prompt = self._follow_up_context(structured_data, clinical_context, original_report)
+        user_prompt = f"""{context_prompt}
 
 Follow-up Question: {question}
 
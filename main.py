@@ -19,7 +19,17 @@ def get_db():
 
 class PulseBot:
     def __init__(self):
-        self.application = ApplicationBuilder().token(settings.telegram_bot_token).build()
+        # По умолчанию PTB обрабатывает обновления строго последовательно:
+        # долгий OCR/LLM-вызов одного чата стопорит кнопки всех остальных.
+        # concurrent_updates снимает это; порядок внутри диалога и так
+        # защищён FSM-состоянием, а тяжёлые стадии ограничены семафорами
+        # в bot_handlers.
+        self.application = (
+            ApplicationBuilder()
+            .token(settings.telegram_bot_token)
+            .concurrent_updates(64)
+            .build()
+        )
         self.application.add_handler(CommandHandler("start", self._wrap(BotHandlers(None).start)))
         self.application.add_handler(CommandHandler("admin", self._wrap(BotHandlers(None).admin)))
         self.application.add_handler(CallbackQueryHandler(self._wrap(BotHandlers(None).handle_callback)))
@@ -35,6 +45,11 @@ class PulseBot:
             try:
                 h = BotHandlers(db)
                 await getattr(h, handler_func.__name__)(update, context)
+            except Exception:
+                # Явный rollback: упавшая транзакция не должна держать
+                # соединение в idle in transaction до закрытия сессии.
+                db.rollback()
+                raise
             finally:
                 db.close()
         return wrapped
@@ -49,6 +64,9 @@ class PulseBot:
 
     async def _post_init(self, app):
         try:
+            # Username бота не меняется — один get_me() на старте вместо
+            # round-trip к Telegram на каждое «Получить ссылку».
+            app.bot_data["me"] = await app.bot.get_me()
             init_db()
             setup_scheduler(app)
             db = get_db()
@@ -5,6 +5,7 @@ from yookassa import Configuration, Payment
 from sqlalchemy.orm import Session
 from database import Payment as PaymentModel, User
 from subscription import SubscriptionManager
+from redis_client import ActivityTracker
 from config import settings
 from loguru import logger
 
@@ -67,7 +68,11 @@ class PaymentService:
             if data.get("event") == "payment.succeeded" or status == "succeeded":
                 rec.status = "completed"
                 rec.completed_at = rec.payment_date = datetime.utcnow()
+                db.query(User).filter(User.id == rec.user_id, User.has_paid == False).update(
+                    {"has_paid": True}, synchronize_session=False
+                )
                 SubscriptionManager.activate_subscription(db, rec.user_id, rec.tariff)
+                ActivityTracker.mark_active(rec.user_id)
                 SubscriptionManager.process_referral_bonus(db, rec.user_id, rec.id)
                 db.commit()
                 out["referrer_telegram_id"] = get_referrer_telegram_id(db, rec.user_id)
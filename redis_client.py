@@ -1,10 +1,19 @@
 """Redis client for FSM and rate limiting."""
 import redis
 import json
+from datetime import date, timedelta
 from typing import Optional, Dict, Any
 from config import settings
 from loguru import logger
 
+# orjson сериализует в C и возвращает bytes (Redis принимает их напрямую);
+# на больших structured_data это в разы быстрее stdlib json.
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:  # pragma: no cover
+    _dumps, _loads = json.dumps, json.loads
+
 # Initialize Redis client with error handling
 redis_client = None
 redis_available = False
@@ -93,30 +102,106 @@ class FSMStorage:
         key = f"fsm_data:{user_id}"
         if not redis_available or not redis_client:
             data = _memory_storage.get(key)
-            return json.loads(data) if isinstance(data, str) else (data if data else {})
-        
+            return _loads(data) if isinstance(data, str) else (data if data else {})
+
         try:
-            data = redis_client.get(key)
-            return json.loads(data) if data else {}
+            raw = redis_client.hgetall(key)
+            return {k: _loads(v) for k, v in raw.items()} if raw else {}
         except Exception as e:
             logger.warning(f"Redis get_data error: {e}, using memory fallback")
             data = _memory_storage.get(key)
-            return json.loads(data) if isinstance(data, str) else (data if data else {})
-    
+            return _loads(data) if isinstance(data, str) else (data if data else {})
+
     @staticmethod
     def set_data(user_id: int, data: Dict[str, Any]):
-        """Set temporary data for user."""
+        """Set temporary data for user (full rewrite)."""
         key = f"fsm_data:{user_id}"
         if not redis_available or not redis_client:
-            _memory_storage[key] = json.dumps(data)
+            _memory_storage[key] = dict(data)
             return
-        
+
         try:
-            redis_client.setex(key, 3600, json.dumps(data))  # 1 hour TTL
+            pipe = redis_client.pipeline()
+            pipe.delete(key)
+            if data:
+                pipe.hset(key, mapping={k: _dumps(v) for k, v in data.items()})
+                pipe.expire(key, 3600)  # 1 hour TTL
+            pipe.execute()
         except Exception as e:
             logger.warning(f"Redis set_data error: {e}, using memory fallback")
-            _memory_storage[key] = json.dumps(data)
+            _memory_storage[key] = dict(data)
+
+    @staticmethod
+    def patch(user_id: int, updates: Dict[str, Any], state: Optional[str] = None):
+        """Обновляет отдельные поля без перезаписи всего словаря.
+
+        Данные лежат в Redis-хэше, поэтому HSET одного поля атомарен:
+        параллельные сообщения не затирают изменения друг друга, а TTL
+        продлевается при каждом обновлении. Опционально в том же pipeline
+        переключает состояние FSM — шаг диалога укладывается в один round-trip.
+        """
+        key = f"fsm_data:{user_id}"
+        if not redis_available or not redis_client:
+            stored = _memory_storage.setdefault(key, {})
+            if isinstance(stored, str):
+                stored = _loads(stored)
+                _memory_storage[key] = stored
+            stored.update(updates)
+            if state is not None:
+                _memory_storage[f"fsm:{user_id}"] = state
+            return
+
+        try:
+            pipe = redis_client.pipeline()
+            pipe.hset(key, mapping={k: _dumps(v) for k, v in updates.items()})
+            pipe.expire(key, 3600)
+            if state is not None:
+                pipe.setex(f"fsm:{user_id}", 3600, state)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis patch error: {e}, using memory fallback")
+            stored = _memory_storage.setdefault(key, {})
+            if isinstance(stored, dict):
+                stored.update(updates)
+            if state is not None:
+                _memory_storage[f"fsm:{user_id}"] = state
     
+    @staticmethod
+    def get_snapshot(user_id: int):
+        """Состояние и данные одним round-trip через pipeline."""
+        if not redis_available or not redis_client:
+            return FSMStorage.get_state(user_id), FSMStorage.get_data(user_id)
+        try:
+            pipe = redis_client.pipeline()
+            pipe.get(f"fsm:{user_id}")
+            pipe.hgetall(f"fsm_data:{user_id}")
+            state, raw = pipe.execute()
+            return state, ({k: _loads(v) for k, v in raw.items()} if raw else {})
+        except Exception as e:
+            logger.warning(f"Redis get_snapshot error: {e}, using memory fallback")
+            return FSMStorage.get_state(user_id), FSMStorage.get_data(user_id)
+
+    @staticmethod
+    def set_snapshot(user_id: int, state: str, data: Dict[str, Any]):
+        """Записывает состояние и данные одним round-trip через pipeline."""
+        if not redis_available or not redis_client:
+            FSMStorage.set_state(user_id, state)
+            FSMStorage.set_data(user_id, data)
+            return
+        try:
+            key = f"fsm_data:{user_id}"
+            pipe = redis_client.pipeline()
+            pipe.setex(f"fsm:{user_id}", 3600, state)
+            pipe.delete(key)
+            if data:
+                pipe.hset(key, mapping={k: _dumps(v) for k, v in data.items()})
+                pipe.expire(key, 3600)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis set_snapshot error: {e}, using memory fallback")
+            _memory_storage[f"fsm:{user_id}"] = state
+            _memory_storage[f"fsm_data:{user_id}"] = dict(data)
+
     @staticmethod
     def clear_data(user_id: int):
         """Clear temporary data for user."""
@@ -132,6 +217,42 @@ class FSMStorage:
             _memory_storage.pop(key, None)
 
 
+class ActivityTracker:
+    """Daily HyperLogLog of active user ids for the dashboard KPI.
+
+    ~12KB per day regardless of user count; pfcount over N day-keys gives the
+    approximate distinct active users for the window in one round-trip.
+    """
+
+    # Dashboard windows go up to 90 days
+    KEY_TTL = 95 * 24 * 3600
+
+    @staticmethod
+    def mark_active(user_id: int):
+        """Record user activity (completed payment or uploaded analysis)."""
+        if not redis_available or not redis_client:
+            return
+        try:
+            key = f"active:{date.today().isoformat()}"
+            redis_client.pfadd(key, user_id)
+            redis_client.expire(key, ActivityTracker.KEY_TTL)
+        except Exception as e:
+            logger.warning(f"Redis mark_active error: {e}")
+
+    @staticmethod
+    def count_active(days: int) -> Optional[int]:
+        """Approximate distinct active users over the last N days, or None."""
+        if not redis_available or not redis_client:
+            return None
+        try:
+            today = date.today()
+            keys = [f"active:{(today - timedelta(days=i)).isoformat()}" for i in range(days)]
+            return int(redis_client.pfcount(*keys))
+        except Exception as e:
+            logger.warning(f"Redis count_active error: {e}")
+            return None
+
+
 class RateLimiter:
     """Rate limiter using Redis with in-memory fallback."""
     
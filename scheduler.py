@@ -1,9 +1,18 @@
 """Scheduled tasks."""
-from datetime import time as dt_time, datetime, timezone
+from datetime import time as dt_time, datetime, timedelta, timezone
+from sqlalchemy import func, select
 from telegram.ext import Application
 from subscription import SubscriptionManager
 from cleanup import cleanup_old_analyses
-from database import SessionLocal, UserNotification, User
+from database import (
+    SessionLocal,
+    AnalysisSession,
+    DashboardSummary,
+    Payment,
+    Referral,
+    UserNotification,
+    User,
+)
 from loguru import logger
 
 
@@ -16,6 +25,35 @@ async def daily_cleanup(context):
         db.close()
 
 
+async def refresh_dashboard_summary(context):
+    """Пересчитываем медленно растущие итоги дашборда (полные сканы таблиц) раз в 5 минут."""
+    db = SessionLocal()
+    try:
+        row = db.execute(select(
+            select(func.count(User.id)).scalar_subquery().label("users"),
+            select(func.count(AnalysisSession.id)).scalar_subquery().label("analyses"),
+            select(func.coalesce(func.sum(Payment.amount), 0)).where(
+                Payment.status == "completed"
+            ).scalar_subquery().label("revenue"),
+            select(func.count(Referral.id)).scalar_subquery().label("referrals"),
+        )).one()
+        db.add(DashboardSummary(
+            total_users=row.users,
+            total_analyses=row.analyses,
+            total_revenue=row.revenue,
+            total_referrals=row.referrals,
+        ))
+        # Keep only recent snapshots
+        cutoff = datetime.utcnow() - timedelta(days=1)
+        db.query(DashboardSummary).filter(DashboardSummary.asof < cutoff).delete()
+        db.commit()
+    except Exception as e:
+        logger.warning(f"Dashboard summary refresh failed: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
 async def send_pending_notifications(context):
     """Каждую минуту проверяем и отправляем просроченные уведомления (scheduled_at <= now UTC)."""
     db = SessionLocal()
@@ -49,3 +87,4 @@ def setup_scheduler(application: Application):
     if job_queue:
         job_queue.run_daily(daily_cleanup, time=dt_time(3, 0), name="daily_cleanup")
         job_queue.run_repeating(send_pending_notifications, interval=60, first=30, name="send_notifications")
+        job_queue.run_repeating(refresh_dashboard_summary, interval=300, first=10, name="dashboard_summary")
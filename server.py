@@ -1,8 +1,9 @@
 """Unified server for bot and webhooks."""
 import asyncio
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import uvicorn
 from telegram import Update
 from telegram.ext import Application
@@ -13,8 +14,8 @@ from loguru import logger
 import json
 
 
-# Create unified FastAPI app
-app = FastAPI(title="Pulse Bot Server")
+# Create unified FastAPI app (orjson responses, matching admin API)
+app = FastAPI(title="Pulse Bot Server", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -25,6 +26,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON responses (admin routes are mounted here in unified mode)
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
 # Import and include admin API routes
 ADMIN_AVAILABLE = False
 try:
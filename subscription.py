@@ -26,12 +26,13 @@ def is_active(user: Optional[User]) -> bool:
     return user.subscription_expire_at > datetime.utcnow()
 
 
-def activate(db: Session, user_id: int, plan: str) -> bool:
+def activate(db: Session, user_id: int, plan: str) -> Optional[User]:
+    """Активирует подписку; возвращает обновлённого пользователя (None при ошибке)."""
     if plan not in PLANS:
-        return False
+        return None
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
-        return False
+        return None
     p = PLANS[plan]
     if is_active(user):
         user.subscription_expire_at += timedelta(days=p["days"])
@@ -44,40 +45,51 @@ def activate(db: Session, user_id: int, plan: str) -> bool:
     user.total_ask_pulse_requests = p["ask_pulse_requests"]
     user.subscription_status = "active"
     db.commit()
-    return True
+    return user
 
 
-def get_requests(user: Optional[User]) -> Tuple[int, int, int, int]:
-    """Возвращает (осталось загрузок, лимит загрузок, бонус, использовано загрузок)."""
-    if not user or not is_active(user):
+def get_requests(user: Optional[User], active: Optional[bool] = None) -> Tuple[int, int, int, int]:
+    """Возвращает (осталось загрузок, лимит загрузок, бонус, использовано загрузок).
+
+    Вызывающие, уже проверившие подписку, передают active — чтобы не
+    считать is_active (и datetime.utcnow) второй раз на тот же рендер.
+    """
+    if active is None:
+        active = is_active(user)
+    if not user or not active:
         return (0, 0, 0, 0)
     t, b, u = user.total_requests or 0, user.bonus_requests or 0, user.used_requests or 0
     return (max(0, t + b - u), t, b, u)
 
 
-def get_ask_pulse_requests(user: Optional[User]) -> Tuple[Optional[int], int]:
+def get_ask_pulse_requests(user: Optional[User], active: Optional[bool] = None) -> Tuple[Optional[int], int]:
     """Возвращает (лимит запросов Спросить Pulse или None = без лимита, использовано)."""
-    if not user or not is_active(user):
+    if active is None:
+        active = is_active(user)
+    if not user or not active:
         return (0, 0)
-    total = getattr(user, "total_ask_pulse_requests", None)
-    used = getattr(user, "used_ask_pulse_requests", 0) or 0
+    total = user.total_ask_pulse_requests
+    used = user.used_ask_pulse_requests or 0
     return (total, used)
 
 
-def can_analyze(db: Session, user_id: int) -> bool:
-    """Загрузка анализов только для Премиум и при наличии лимита."""
-    user = db.query(User).filter(User.id == user_id).first()
+def can_analyze(db: Session, user_id: int, user: Optional[User] = None) -> bool:
+    """Загрузка анализов только для Премиум и при наличии лимита.
+
+    user, если он уже загружен вызывающим, избавляет от повторного SELECT.
+    """
+    user = user or db.query(User).filter(User.id == user_id).first()
     if not user or not is_active(user) or (user.subscription_plan or "basic") != "premium":
         return False
-    return get_requests(user)[0] > 0
+    return get_requests(user, active=True)[0] > 0
 
 
-def can_ask_pulse(db: Session, user_id: int) -> bool:
+def can_ask_pulse(db: Session, user_id: int, user: Optional[User] = None) -> bool:
     """Спросить Pulse: активная подписка и (нет лимита или есть остаток)."""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = user or db.query(User).filter(User.id == user_id).first()
     if not user or not is_active(user):
         return False
-    total, used = get_ask_pulse_requests(user)
+    total, used = get_ask_pulse_requests(user, active=True)
     if total is None:
         return True
     return used < total
@@ -85,7 +97,7 @@ def can_ask_pulse(db: Session, user_id: int) -> bool:
 
 def use_request(db: Session, user_id: int) -> bool:
     user = db.query(User).filter(User.id == user_id).first()
-    if not user or not can_analyze(db, user_id):
+    if not user or not can_analyze(db, user_id, user):
         return False
     user.used_requests = (user.used_requests or 0) + 1
     db.commit()
@@ -94,11 +106,11 @@ def use_request(db: Session, user_id: int) -> bool:
 
 def use_ask_pulse_request(db: Session, user_id: int) -> bool:
     user = db.query(User).filter(User.id == user_id).first()
-    if not user or not can_ask_pulse(db, user_id):
+    if not user or not can_ask_pulse(db, user_id, user):
         return False
-    total = getattr(user, "total_ask_pulse_requests", None)
+    total = user.total_ask_pulse_requests
     if total is not None:
-        user.used_ask_pulse_requests = (getattr(user, "used_ask_pulse_requests", 0) or 0) + 1
+        user.used_ask_pulse_requests = (user.used_ask_pulse_requests or 0) + 1
     db.commit()
     return True
 
@@ -112,16 +124,16 @@ def add_bonus(db: Session, user_id: int, amount: int) -> bool:
     return True
 
 
-def deactivate(db: Session, user_id: int) -> bool:
-    """Remove subscription from user (admin)."""
+def deactivate(db: Session, user_id: int) -> Optional[User]:
+    """Remove subscription from user (admin). Returns the updated user."""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
-        return False
+        return None
     user.subscription_status = "inactive"
     user.subscription_expire_at = None
     user.bonus_requests = 0
     db.commit()
-    return True
+    return user
 
 
 def expire_subscriptions(db: Session) -> int:
@@ -133,7 +145,7 @@ def expire_subscriptions(db: Session) -> int:
         u.subscription_status = "expired"
         u.bonus_requests = 0
         u.used_requests = 0
-        u.used_ask_pulse_requests = getattr(u, "used_ask_pulse_requests", 0) or 0
+        u.used_ask_pulse_requests = u.used_ask_pulse_requests or 0
     db.commit()
     return len(q)
 